@@ -0,0 +1,127 @@
+"""
+Микро-бенчмарк разбора тела вызова робота.
+Сравнивает прежний путь (Starlette request.form() + dict + поиск ключей по startswith)
+с однопроходным парсером form_parser.parse_robot_call.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_form_parser [--iterations 20000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for _name in ("CLIENT_ID", "CLIENT_SECRET", "HOST_URL"):
+    os.environ.setdefault(_name, "benchmark")
+
+from starlette.requests import Request  # noqa: E402
+from form_parser import parse_robot_call  # noqa: E402
+
+# Тело, которое Битрикс присылает при вызове робота
+BODY = urlencode([
+    ("workflow_id", "65f1d5a3c1b2a4.12345678"),
+    ("code", "REST_ROBOT_MY_UNIQUE_V3"),
+    ("document_id[0]", "crm"),
+    ("document_id[1]", "CCrmDocumentDeal"),
+    ("document_id[2]", "DEAL_1234"),
+    ("document_type[0]", "crm"),
+    ("document_type[1]", "CCrmDocumentDeal"),
+    ("document_type[2]", "DEAL"),
+    ("event_token", "65f1d5a3c1b2a4.12345678|A|REST_ROBOT_MY_UNIQUE_V3|ab12cd34ef56"),
+    ("properties[LAST_NAME]", "Иванов"),
+    ("properties[NAME]", "Иван"),
+    ("properties[SECOND_NAME]", "Иванович"),
+    ("properties[PHONE]", "+7 (999) 123-45-67"),
+    ("properties[EMAIL]", "ivanov@example.com"),
+    ("use_subscription", "Y"),
+    ("timeout_duration", "0"),
+    ("ts", "1710345678"),
+    ("auth[access_token]", "a" * 70),
+    ("auth[expires]", "1710349278"),
+    ("auth[expires_in]", "3600"),
+    ("auth[scope]", "crm,bizproc"),
+    ("auth[domain]", "example.bitrix24.ru"),
+    ("auth[server_endpoint]", "https://oauth.bitrix.info/rest/"),
+    ("auth[status]", "L"),
+    ("auth[client_endpoint]", "https://example.bitrix24.ru/rest/"),
+    ("auth[member_id]", "0123456789abcdef0123456789abcdef"),
+    ("auth[user_id]", "1"),
+    ("auth[application_token]", "f" * 32),
+]).encode()
+
+
+def _request() -> Request:
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/api/bitrix24",
+        "headers": [(b"content-type", b"application/x-www-form-urlencoded")],
+    }
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            return {"type": "http.disconnect"}
+        sent = True
+        return {"type": "http.request", "body": BODY, "more_body": False}
+
+    return Request(scope, receive)
+
+
+async def old_path():
+    form = await _request().form()
+    data = dict(form)
+    auth_data = {k: v for k, v in data.items() if k.startswith("auth[")}
+    return (
+        form.get("event_token"),
+        form.get("properties[LAST_NAME]", ""),
+        form.get("properties[NAME]", ""),
+        form.get("properties[SECOND_NAME]"),
+        form.get("properties[PHONE]"),
+        form.get("properties[EMAIL]"),
+        auth_data.get("auth[domain]"),
+        auth_data.get("auth[member_id]"),
+    )
+
+
+async def new_path():
+    call = parse_robot_call(await _request().body())
+    p = call.properties
+    return (
+        call.event_token,
+        p.get("LAST_NAME", ""),
+        p.get("NAME", ""),
+        p.get("SECOND_NAME"),
+        p.get("PHONE"),
+        p.get("EMAIL"),
+        call.auth.domain,
+        call.auth.member_id,
+    )
+
+
+async def measure(fn, iterations: int) -> float:
+    for _ in range(min(1000, iterations)):
+        await fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+async def main(iterations: int):
+    assert await old_path() == await new_path(), "parsers disagree"
+    old = await measure(old_path, iterations)
+    new = await measure(new_path, iterations)
+    print(f"request.form() + dict scan : {old:8.2f} us/call")
+    print(f"parse_robot_call           : {new:8.2f} us/call")
+    print(f"speedup                    : {old / new:8.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    asyncio.run(main(parser.parse_args().iterations))
@@ -0,0 +1,226 @@
+"""
+Локальная замена REST API Битрикс24 и OAuth-сервера для нагрузочных тестов.
+
+Эмулирует методы, которыми пользуется BitrixClient (crm.contact.add, bizproc.event.send,
+bizproc.robot.add/update/delete, crm.duplicate.findbycomm, batch), и /oauth/token/.
+Поддерживает задержку ответа, случайные ошибки и leaky bucket как у настоящего портала
+(503 QUERY_LIMIT_EXCEEDED).
+
+Запуск:
+    python -m benchmarks.bitrix_stub --port 9100 --latency-ms 40 --error-rate 0.01
+
+Приложение настраивается на заглушку так:
+    BITRIX_REST_SCHEME=http
+    BITRIX_OAUTH_URL=http://127.0.0.1:9100
+а домен портала при установке — 127.0.0.1:9100.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+from typing import Any, Dict, Tuple
+from urllib.parse import parse_qsl
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+class StubConfig:
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    rate: float = 2.0
+    burst: int = 50
+    rate_limit: bool = True
+
+
+config = StubConfig()
+app = FastAPI(title="Bitrix24 REST stand-in")
+
+_contact_ids = itertools.count(1)
+_calls: Counter = Counter()
+_buckets: Dict[str, Tuple[float, float]] = {}
+_robots: Dict[str, dict] = {}
+_contacts_by_comm: Dict[str, int] = {}
+
+
+def _bucket_allows(portal: str) -> bool:
+    """Leaky bucket Битрикса: счетчик растет на каждый запрос и утекает со скоростью rate."""
+    if not config.rate_limit:
+        return True
+    now = time.monotonic()
+    level, updated = _buckets.get(portal, (0.0, now))
+    level = max(0.0, level - (now - updated) * config.rate)
+    if level + 1 > config.burst:
+        _buckets[portal] = (level, now)
+        return False
+    _buckets[portal] = (level + 1, now)
+    return True
+
+
+async def _delay():
+    if config.latency_ms or config.jitter_ms:
+        await asyncio.sleep(max(0.0, random.gauss(config.latency_ms, config.jitter_ms)) / 1000)
+
+
+def _error(code: str, description: str, status: int = 400) -> Tuple[int, Dict[str, Any]]:
+    return status, {"error": code, "error_description": description}
+
+
+def _nested(pairs) -> Dict[str, Any]:
+    """Разбор PHP-ключей вида fields[PHONE][0][VALUE] из команд batch."""
+    result: Dict[str, Any] = {}
+    for key, value in pairs:
+        parts = key.replace("]", "").split("[")
+        node = result
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return result
+
+
+def _comm_values(params: dict, field: str):
+    values = params.get("fields", {}).get(field) or {}
+    items = values.values() if isinstance(values, dict) else values
+    return [v.get("VALUE") for v in items if isinstance(v, dict) and v.get("VALUE")]
+
+
+def _execute(method: str, params: dict) -> Tuple[int, Dict[str, Any]]:
+    _calls[method] += 1
+    if config.error_rate and random.random() < config.error_rate:
+        return _error("INTERNAL_SERVER_ERROR", "Injected failure", 500)
+
+    if method == "crm.contact.add":
+        contact_id = next(_contact_ids)
+        for value in _comm_values(params, "PHONE") + _comm_values(params, "EMAIL"):
+            _contacts_by_comm[value] = contact_id
+        return 200, {"result": contact_id}
+    if method == "crm.duplicate.findbycomm":
+        values = params.get("values") or {}
+        values = values.values() if isinstance(values, dict) else values
+        ids = sorted({_contacts_by_comm[v] for v in values if v in _contacts_by_comm})
+        return 200, {"result": {"CONTACT": ids} if ids else []}
+    if method == "bizproc.event.send":
+        if not params.get("event_token"):
+            return _error("ERROR_WRONG_EVENT_TOKEN", "Event token is empty")
+        return 200, {"result": True}
+    if method == "bizproc.robot.add":
+        if params.get("CODE") in _robots:
+            return _error("ERROR_ACTIVITY_ALREADY_INSTALLED", "Activity already installed")
+        _robots[params.get("CODE")] = params
+        return 200, {"result": True}
+    if method == "bizproc.robot.update":
+        if params.get("CODE") not in _robots:
+            return _error("ERROR_ACTIVITY_NOT_FOUND", "Activity not found")
+        _robots[params["CODE"]].update(params.get("FIELDS") or {})
+        return 200, {"result": True}
+    if method == "bizproc.robot.delete":
+        if _robots.pop(params.get("CODE"), None) is None:
+            return _error("ERROR_ACTIVITY_NOT_FOUND", "Activity not found")
+        return 200, {"result": True}
+    return _error("ERROR_METHOD_NOT_FOUND", f"Method not found: {method}", 404)
+
+
+def _substitute(value: Any, results: Dict[str, Any]) -> Any:
+    if isinstance(value, dict):
+        return {k: _substitute(v, results) for k, v in value.items()}
+    if isinstance(value, str) and value.startswith("$result[") and value.endswith("]"):
+        return results.get(value[len("$result["):-1], value)
+    return value
+
+
+def _batch(params: dict) -> Tuple[int, Dict[str, Any]]:
+    results: Dict[str, Any] = {}
+    errors: Dict[str, Any] = {}
+    halt = str(params.get("halt", "0")) not in ("0", "", "false")
+    for key, command in (params.get("cmd") or {}).items():
+        method, _, query = command.partition("?")
+        sub_params = _substitute(_nested(parse_qsl(query, keep_blank_values=True)), results)
+        status, body = _execute(method, sub_params)
+        if status == 200:
+            results[key] = body["result"]
+        else:
+            errors[key] = body
+            if halt:
+                break
+    return 200, {"result": {"result": results, "result_error": errors, "result_total": [], "result_next": []}}
+
+
+@app.post("/rest/{method}.json")
+async def rest(method: str, request: Request):
+    await _delay()
+    portal = request.headers.get("host", "portal")
+    if not _bucket_allows(portal):
+        _calls["503"] += 1
+        return JSONResponse({"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"},
+                            status_code=503)
+    if not request.query_params.get("auth"):
+        return JSONResponse({"error": "NO_AUTH_FOUND", "error_description": "Wrong authorization data"},
+                            status_code=401)
+
+    params = await request.json() if await request.body() else {}
+    _calls["http_requests"] += 1
+    if method == "batch":
+        _calls["batch"] += 1
+        status, body = _batch(params or {})
+    else:
+        status, body = _execute(method, params or {})
+    return JSONResponse(body, status_code=status)
+
+
+@app.post("/oauth/token/")
+async def oauth_token(request: Request):
+    await _delay()
+    form = dict(parse_qsl((await request.body()).decode()))
+    _calls[f"oauth.{form.get('grant_type')}"] += 1
+    now = int(time.time())
+    return JSONResponse({
+        "access_token": f"stub-access-{now}-{random.randrange(10 ** 6)}",
+        "refresh_token": f"stub-refresh-{now}-{random.randrange(10 ** 6)}",
+        "expires": now + 3600,
+        "expires_in": 3600,
+        "domain": "oauth.bitrix.info",
+        "member_id": "stub-member",
+        "scope": "crm,bizproc"
+    })
+
+
+@app.get("/stats")
+async def stats():
+    return JSONResponse(dict(_calls))
+
+
+@app.post("/stats/reset")
+async def reset_stats():
+    _calls.clear()
+    _buckets.clear()
+    return JSONResponse({"status": "reset"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bitrix24 REST stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Средняя задержка ответа")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Стандартное отклонение задержки")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля команд, отвечающих ошибкой 500")
+    parser.add_argument("--rate", type=float, default=2.0, help="Скорость утечки leaky bucket, запросов/с")
+    parser.add_argument("--burst", type=int, default=50, help="Емкость leaky bucket")
+    parser.add_argument("--no-rate-limit", action="store_true", help="Отключить 503 QUERY_LIMIT_EXCEEDED")
+    args = parser.parse_args()
+
+    config.latency_ms = args.latency_ms
+    config.jitter_ms = args.jitter_ms
+    config.error_rate = args.error_rate
+    config.rate = args.rate
+    config.burst = args.burst
+    config.rate_limit = not args.no_rate_limit
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Нагрузочный тест робота против заглушки Битрикса (benchmarks/bitrix_stub.py).
+
+Сценарии:
+    robot   — POST /api/bitrix24 с реалистичным телом вызова робота;
+    install — GET /bitrix/oauth/install?code=... (обмен кода и регистрация робота).
+
+Отчет: пропускная способность, p50/p95/p99 задержки, число REST-запросов к порталу
+на одно выполнение. Результат сохраняется в benchmarks/results/ (JSON с хэшем коммита),
+чтобы сравнивать прогоны между коммитами (--compare).
+
+Пример:
+    python -m benchmarks.bitrix_stub --port 9100 --latency-ms 40 &
+    BITRIX_REST_SCHEME=http BITRIX_OAUTH_URL=http://127.0.0.1:9100 uvicorn main:app --port 8000 &
+    python -m benchmarks.load_test --scenario robot --requests 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import httpx
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def robot_payload(domain: str, index: int) -> Dict[str, str]:
+    event_token = f"{uuid.uuid4().hex}|A|REST_ROBOT_MY_UNIQUE_V3|{index}"
+    return {
+        "workflow_id": uuid.uuid4().hex[:24],
+        "code": "REST_ROBOT_MY_UNIQUE_V3",
+        "document_id[0]": "crm",
+        "document_id[1]": "CCrmDocumentDeal",
+        "document_id[2]": f"DEAL_{index}",
+        "document_type[0]": "crm",
+        "document_type[1]": "CCrmDocumentDeal",
+        "document_type[2]": "DEAL",
+        "event_token": event_token,
+        "properties[LAST_NAME]": f"Иванов{index}",
+        "properties[NAME]": "Иван",
+        "properties[SECOND_NAME]": "Иванович",
+        "properties[PHONE]": f"+7 999 {index:07d}",
+        "properties[EMAIL]": f"user{index}@example.com",
+        "use_subscription": "Y",
+        "ts": str(int(time.time())),
+        "auth[access_token]": "load-test-access",
+        "auth[expires]": str(int(time.time()) + 3600),
+        "auth[domain]": domain,
+        "auth[member_id]": "load-test-member",
+        "auth[application_token]": os.environ.get("ALLOWED_EVENT_TOKEN", "load-test-app"),
+    }
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # nearest-rank
+    index = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def prepare_portal(client: httpx.AsyncClient, target: str, domain: str):
+    """Событие установки приложения: сохраняет токены портала-заглушки и регистрирует робота."""
+    resp = await client.post(f"{target}/bitrix/oauth/install", data={
+        "event": "ONAPPINSTALL",
+        "auth[access_token]": "load-test-access",
+        "auth[refresh_token]": "load-test-refresh",
+        "auth[expires]": str(int(time.time()) + 3600),
+        "auth[domain]": domain,
+        "auth[member_id]": "load-test-member",
+        "auth[application_token]": os.environ.get("ALLOWED_EVENT_TOKEN", "load-test-app"),
+    })
+    resp.raise_for_status()
+
+
+async def run_load(args: argparse.Namespace) -> Dict:
+    domain = args.domain or urlparse(args.stub).netloc
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        if args.scenario == "robot":
+            await prepare_portal(client, args.target, domain)
+        await client.post(f"{args.stub}/stats/reset")
+
+        latencies: List[float] = []
+        statuses: Dict[str, int] = {}
+        counter = iter(range(args.requests))
+
+        async def one(index: int):
+            started = time.perf_counter()
+            try:
+                if args.scenario == "robot":
+                    resp = await client.post(f"{args.target}/api/bitrix24", data=robot_payload(domain, index))
+                else:
+                    resp = await client.get(f"{args.target}/bitrix/oauth/install",
+                                            params={"code": uuid.uuid4().hex, "domain": domain,
+                                                    "member_id": "load-test-member"})
+                key = str(resp.status_code)
+            except httpx.HTTPError as e:
+                key = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[key] = statuses.get(key, 0) + 1
+
+        async def worker():
+            for index in counter:
+                await one(index)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+        # В асинхронном режиме REST-вызовы продолжаются после ответа обработчика
+        if args.settle:
+            await asyncio.sleep(args.settle)
+        stub_calls = (await client.get(f"{args.stub}/stats")).json()
+
+    latencies.sort()
+    executions = max(1, args.requests)
+    commands = sum(v for k, v in stub_calls.items()
+                   if k not in ("http_requests", "batch", "503") and not k.startswith("oauth."))
+    return {
+        "scenario": args.scenario,
+        "label": args.label,
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(args.requests / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        },
+        "statuses": statuses,
+        "rest_http_requests_per_execution": round(stub_calls.get("http_requests", 0) / executions, 3),
+        "rest_commands_per_execution": round(commands / executions, 3),
+        "rate_limited_responses": stub_calls.get("503", 0),
+        "stub_calls": stub_calls,
+    }
+
+
+def save_result(result: Dict) -> str:
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    name = f"{stamp}_{result['scenario']}_{result['commit'] or 'nocommit'}.json"
+    path = os.path.join(RESULTS_DIR, name)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=4, ensure_ascii=False)
+    return path
+
+
+def print_report(result: Dict, baseline: Optional[Dict] = None):
+    rows = [
+        ("throughput, req/s", result["throughput_rps"], baseline and baseline["throughput_rps"]),
+        ("latency p50, ms", result["latency_ms"]["p50"], baseline and baseline["latency_ms"]["p50"]),
+        ("latency p95, ms", result["latency_ms"]["p95"], baseline and baseline["latency_ms"]["p95"]),
+        ("latency p99, ms", result["latency_ms"]["p99"], baseline and baseline["latency_ms"]["p99"]),
+        ("REST requests / execution", result["rest_http_requests_per_execution"],
+         baseline and baseline["rest_http_requests_per_execution"]),
+        ("REST commands / execution", result["rest_commands_per_execution"],
+         baseline and baseline["rest_commands_per_execution"]),
+    ]
+    print(f"scenario={result['scenario']} commit={result['commit']} requests={result['requests']} "
+          f"concurrency={result['concurrency']} statuses={result['statuses']}")
+    for name, value, base in rows:
+        line = f"  {name:<28}{value:>12}"
+        if base:
+            line += f"   (baseline {base}, {(value - base) / base * 100:+.1f}%)"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the robot against the Bitrix stand-in")
+    parser.add_argument("--target", default="http://127.0.0.1:8000", help="Адрес приложения")
+    parser.add_argument("--stub", default="http://127.0.0.1:9100", help="Адрес заглушки Битрикса")
+    parser.add_argument("--domain", default=None, help="Домен портала (по умолчанию host:port заглушки)")
+    parser.add_argument("--scenario", choices=["robot", "install"], default="robot")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--settle", type=float, default=0.0,
+                        help="Пауза перед чтением счетчиков заглушки (для асинхронного режима)")
+    parser.add_argument("--label", default="", help="Метка прогона в сохраненном результате")
+    parser.add_argument("--compare", default=None, help="JSON предыдущего прогона для сравнения")
+    parser.add_argument("--no-save", action="store_true", help="Не сохранять результат")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_load(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if not args.no_save:
+        print(f"saved to {save_result(result)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import json
+import os
+from config import settings
+from logging_config import setup_logging
+from dependencies import http_pool, token_repository, get_contact_index
+from repositories.sqlite_token_store import SqliteTokenRepository
+from services.contact_import import ContactImporter
+from services.processing import RobotService
+
+setup_logging()
+
+
+async def resync(args: argparse.Namespace):
+    """Перерегистрирует робота на всех порталах из хранилища токенов."""
+    await http_pool.start()
+    try:
+        service = RobotService(token_repository, http_pool.client, get_contact_index())
+        result = await service.resync_all(concurrency=args.concurrency, force=args.force)
+        print(json.dumps(result, indent=4, ensure_ascii=False))
+    finally:
+        await http_pool.close()
+        if isinstance(token_repository, SqliteTokenRepository):
+            await token_repository.close()
+
+
+async def import_contacts(args: argparse.Namespace):
+    """Импортирует контакты из CSV/JSONL в портал; прерванный импорт продолжается с checkpoint."""
+    await http_pool.start()
+    try:
+        service = RobotService(token_repository, http_pool.client, get_contact_index())
+        importer = ContactImporter(service, args.domain, args.file, fmt=args.format,
+                                   results_path=args.results, checkpoint_path=args.checkpoint,
+                                   chunk_size=args.chunk_size, concurrency=args.concurrency)
+        if args.restart and os.path.exists(importer.checkpoint_path):
+            os.remove(importer.checkpoint_path)
+        result = await importer.run()
+        print(json.dumps(result, indent=4, ensure_ascii=False))
+    finally:
+        await http_pool.close()
+        if isinstance(token_repository, SqliteTokenRepository):
+            await token_repository.close()
+
+
+def serve(args: argparse.Namespace):
+    """
+    Запускает приложение в одном или нескольких процессах uvicorn.
+    Воркеры согласуют токены через блокировку хранилища и делят между собой лимит запросов к порталу.
+    """
+    import uvicorn
+
+    # Воркеры — отдельные процессы: настройки они читают из окружения заново
+    os.environ["SERVER_WORKERS"] = str(args.workers)
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop=args.loop,
+        http=args.http,
+        access_log=not args.no_access_log,
+        # Логирование настраивает приложение (setup_logging), а не uvicorn
+        log_config=None
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Служебные команды Bitrix24 REST-робота")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    resync_parser = commands.add_parser("resync", help="Перерегистрировать робота на всех порталах")
+    resync_parser.add_argument("--concurrency", type=int, default=None,
+                               help="Сколько порталов обрабатывать одновременно")
+    resync_parser.add_argument("--force", action="store_true",
+                               help="Перерегистрировать даже если конфигурация не менялась")
+    resync_parser.set_defaults(handler=resync)
+
+    import_parser = commands.add_parser("import-contacts", help="Импортировать контакты из CSV/JSONL")
+    import_parser.add_argument("file", help="CSV с заголовком или JSONL (колонки LAST_NAME, NAME, SECOND_NAME, PHONE, EMAIL)")
+    import_parser.add_argument("--domain", required=True, help="Домен портала")
+    import_parser.add_argument("--format", choices=["csv", "jsonl"], default=None,
+                               help="Формат файла (по умолчанию — по расширению)")
+    import_parser.add_argument("--chunk-size", type=int, default=None, help="Строк в одном batch-запросе (до 50)")
+    import_parser.add_argument("--concurrency", type=int, default=None, help="Batch-запросов одновременно")
+    import_parser.add_argument("--results", default=None,
+                               help="Файл результатов (по умолчанию FILE.results.jsonl; для файлов из IMPORT_DIR — как у API)")
+    import_parser.add_argument("--checkpoint", default=None,
+                               help="Файл checkpoint (по умолчанию FILE.checkpoint.json; для файлов из IMPORT_DIR — как у API)")
+    import_parser.add_argument("--restart", action="store_true", help="Начать заново, игнорируя checkpoint")
+    import_parser.set_defaults(handler=import_contacts)
+
+    serve_parser = commands.add_parser("serve", help="Запустить приложение (несколько воркеров)")
+    serve_parser.add_argument("--host", default=settings.SERVER_HOST)
+    serve_parser.add_argument("--port", type=int, default=settings.SERVER_PORT)
+    serve_parser.add_argument("--workers", type=int, default=settings.SERVER_WORKERS,
+                              help="Число процессов uvicorn")
+    serve_parser.add_argument("--loop", choices=["auto", "asyncio", "uvloop"], default=settings.SERVER_LOOP,
+                              help="Event loop (auto — uvloop, если установлен)")
+    serve_parser.add_argument("--http", choices=["auto", "h11", "httptools"], default=settings.SERVER_HTTP,
+                              help="HTTP-парсер (auto — httptools, если установлен)")
+    serve_parser.add_argument("--no-access-log", action="store_true", help="Отключить access-лог uvicorn")
+    serve_parser.set_defaults(handler=serve)
+
+    args = parser.parse_args()
+    result = args.handler(args)
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,8 +8,96 @@ class Settings(BaseSettings):
     CLIENT_ID: str
     CLIENT_SECRET: str
     HOST_URL: str
+    # Хранилище токенов: "json" (один портал, tokens.json) или "sqlite" (много порталов)
+    TOKEN_STORE: str = "json"
     TOKENS_FILE: str = "tokens.json"
+    TOKENS_DB: str = "tokens.db"
+    TOKENS_CACHE_CHECK_INTERVAL: float = 1.0
+    TOKENS_SAVE_DELAY: float = 0.05
+    # За сколько секунд до истечения access_token обновлять его заранее
+    TOKEN_REFRESH_MARGIN: float = 300.0
+
+    # Микро-батчинг REST-вызовов через batch.json
+    BITRIX_BATCH_ENABLED: bool = False
+    BITRIX_BATCH_WINDOW: float = 0.02
+    BITRIX_BATCH_MAX_COMMANDS: int = 50
+
+    # Ограничение частоты запросов к порталу (leaky bucket Bitrix24: 2 запроса/с, запас 50)
+    BITRIX_RATE_LIMIT_ENABLED: bool = True
+    BITRIX_RATE_LIMIT_RATE: float = 2.0
+    BITRIX_RATE_LIMIT_BURST: int = 50
+    BITRIX_RATE_LIMIT_MAX_QUEUE: int = 1000
+    BITRIX_RATE_LIMIT_QUEUE_TIMEOUT: float = 30.0
+    BITRIX_RATE_LIMIT_MAX_RETRIES: int = 3
+    BITRIX_RATE_LIMIT_BACKOFF_BASE: float = 1.0
+    BITRIX_RATE_LIMIT_BACKOFF_MAX: float = 30.0
+
+    # Защита от повторной обработки вызова робота с тем же event_token
+    IDEMPOTENCY_ENABLED: bool = True
+    IDEMPOTENCY_DB: str = "idempotency.db"
+    IDEMPOTENCY_CACHE_SIZE: int = 10000
+    IDEMPOTENCY_TTL: float = 86400.0
+    IDEMPOTENCY_PURGE_INTERVAL: float = 3600.0
+    # Сколько секунд повтор из другого воркера ждет незавершенный вызов, прежде чем выполнить его сам
+    IDEMPOTENCY_PENDING_TIMEOUT: float = 120.0
+
+    # Поиск существующего контакта по телефону/email вместо создания дубля
+    CONTACT_DEDUP_ENABLED: bool = False
+    CONTACT_DEDUP_DB: str = "contacts.db"
+    CONTACT_DEDUP_TTL: float = 604800.0
+    CONTACT_DEDUP_COUNTRY_CODE: str = "7"
+
+    # Сколько порталов одновременно обрабатывает массовая перерегистрация робота
+    ROBOT_RESYNC_CONCURRENCY: int = 10
+
+    # Массовый импорт контактов (python cli.py import-contacts, POST /api/import/contacts)
+    IMPORT_API_KEY: str = ""
+    IMPORT_DIR: str = "imports"
+    IMPORT_CHUNK_SIZE: int = 50
+    IMPORT_CONCURRENCY: int = 2
+
+    # Логирование: уровень, формат (json / text), файл (пусто — stderr), размер очереди записей;
+    # одинаковые ошибки: burst записей за window секунд, затем каждая sample-я (0 — ни одной)
+    LOG_LEVEL: str = "INFO"
+    LOG_FORMAT: str = "json"
+    LOG_FILE: str = ""
+    LOG_QUEUE_SIZE: int = 10000
+    LOG_ERROR_BURST: int = 10
+    LOG_ERROR_WINDOW: float = 60.0
+    LOG_ERROR_SAMPLE: int = 100
+
+    # Метка portal в метриках REST-вызовов (при сотнях порталов можно отключить)
+    METRICS_PER_PORTAL: bool = True
+
+    # Асинхронный режим робота: вызов ставится в очередь на диске, ответ Битриксу — сразу
+    ROBOT_ASYNC_MODE: bool = False
+    JOBS_DB: str = "jobs.db"
+    JOB_WORKERS: int = 4
+    JOB_MAX_ATTEMPTS: int = 5
+    JOB_RETRY_BASE_DELAY: float = 2.0
+    JOB_RETRY_MAX_DELAY: float = 300.0
+    # Аренда задачи: если воркер не продлевал ее столько секунд, задача возвращается в очередь
+    JOB_LEASE_TIMEOUT: float = 60.0
     BITRIX_OAUTH_URL: str = "https://oauth.bitrix.info"
+    # Схема REST-адресов порталов (http — только для локальной заглушки benchmarks/bitrix_stub.py)
+    BITRIX_REST_SCHEME: str = "https"
+    # Если задан, вызовы робота принимаются только с таким auth[application_token]
+    ALLOWED_EVENT_TOKEN: str = ""
+
+    # Запуск через "python cli.py serve": число процессов, event loop и HTTP-парсер uvicorn
+    SERVER_HOST: str = "0.0.0.0"
+    SERVER_PORT: int = 8000
+    SERVER_WORKERS: int = 1
+    SERVER_LOOP: str = "auto"
+    SERVER_HTTP: str = "auto"
+
+    # Пул HTTP-соединений к порталам
+    HTTP_MAX_CONNECTIONS: int = 100
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    HTTP_KEEPALIVE_EXPIRY: float = 30.0
+    HTTP2_ENABLED: bool = False
+    HTTP_CONNECT_TIMEOUT: float = 5.0
+    HTTP_READ_TIMEOUT: float = 10.0
 
     class Config:
         env_file = ".env"
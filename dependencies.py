@@ -1,21 +1,84 @@
 import httpx
-from typing import AsyncGenerator
+from typing import Optional
 from fastapi import Depends
 from config import settings
-from repositories.token_store import JsonTokenRepository, ITokenRepository
+from logging_config import log_context
+from metrics import registry
+from repositories.token_store import CachedJsonTokenRepository, ITokenRepository
+from repositories.sqlite_token_store import SqliteTokenRepository
+from services.http_pool import HttpClientPool
+from services.contact_dedup import ContactIndex
+from services.idempotency import IdempotencyGuard
+from services.job_queue import JobQueue, JobWorkerPool
 from services.processing import RobotService
+from schemas import ContactCreateDTO
+
+# Единый пул соединений, запускается и закрывается в lifespan приложения
+http_pool = HttpClientPool()
+
+def _pool_usage() -> dict:
+    stats = http_pool.stats()
+    return {(state,): stats[state] for state in ("active", "idle", "queued_requests")}
+
+registry.gauge("http_pool_connections", "HTTP connection pool usage", ("state",), collect=_pool_usage)
+
+# Хранилище токенов живет всё время работы приложения, чтобы кэш не терялся между запросами
+def _build_token_repository() -> ITokenRepository:
+    if settings.TOKEN_STORE == "sqlite":
+        return SqliteTokenRepository(settings.TOKENS_DB, check_interval=settings.TOKENS_CACHE_CHECK_INTERVAL)
+    return CachedJsonTokenRepository(
+        settings.TOKENS_FILE,
+        check_interval=settings.TOKENS_CACHE_CHECK_INTERVAL,
+        save_delay=settings.TOKENS_SAVE_DELAY
+    )
+
+token_repository = _build_token_repository()
 
 def get_repository() -> ITokenRepository:
-    return JsonTokenRepository(settings.TOKENS_FILE)
+    return token_repository
+
+# Локальный индекс контактов (режим поиска дублей)
+contact_index = ContactIndex(settings.CONTACT_DEDUP_DB)
+
+def get_contact_index() -> Optional[ContactIndex]:
+    return contact_index if settings.CONTACT_DEDUP_ENABLED else None
 
-# HTTP Client (Resource Management)
-async def get_http_client() -> AsyncGenerator[httpx.AsyncClient, None]:
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        yield client
+# HTTP Client (общий keep-alive пул)
+def get_http_client() -> httpx.AsyncClient:
+    return http_pool.client
 
 # Сервис
 async def get_robot_service(
     repo: ITokenRepository = Depends(get_repository),
     http_client: httpx.AsyncClient = Depends(get_http_client)
 ) -> RobotService:
-    return RobotService(repo, http_client)
\ No newline at end of file
+    return RobotService(repo, http_client, get_contact_index())
+
+# Повторные вызовы робота с тем же event_token не доходят до портала
+idempotency_guard = IdempotencyGuard(settings.IDEMPOTENCY_DB)
+
+async def process_robot_call(service: RobotService, event_token: str, contact: ContactCreateDTO,
+                             domain: str = None, member_id: str = None) -> dict:
+    async def run():
+        return await service.process_robot_request(event_token, contact, domain=domain, member_id=member_id)
+
+    if settings.IDEMPOTENCY_ENABLED:
+        return await idempotency_guard.run(event_token, run)
+    return await run()
+
+# Очередь задач робота (асинхронный режим)
+job_queue = JobQueue(settings.JOBS_DB)
+
+async def run_robot_job(payload: dict):
+    # Воркер очереди выполняет задачи одну за другой: контекст логов не должен переходить к следующей
+    with log_context(portal=payload.get("domain"), event_token=payload["event_token"]):
+        service = RobotService(token_repository, http_pool.client, get_contact_index())
+        await process_robot_call(
+            service,
+            payload["event_token"],
+            ContactCreateDTO(**payload["contact"]),
+            domain=payload.get("domain"),
+            member_id=payload.get("member_id")
+        )
+
+job_workers = JobWorkerPool(job_queue, run_robot_job)
\ No newline at end of file
@@ -0,0 +1,137 @@
+import hmac
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import unquote_plus
+from config import settings
+from schemas import RobotAuth, RobotCallPayload
+
+_AUTH_FIELDS = frozenset(RobotAuth.model_fields)
+_INT_AUTH_FIELDS = frozenset({"expires", "expires_in"})
+
+
+def _to_int(value: Any) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _str(value: Any) -> Optional[str]:
+    # Вложенные структуры (properties[NAME][x]=...) на месте строки не принимаем
+    return value if isinstance(value, str) else None
+
+
+def _unquote(value: str) -> str:
+    # unquote_plus заметно дороже проверки: большинство значений кодировать не нужно
+    if "%" in value or "+" in value:
+        return unquote_plus(value)
+    return value
+
+
+def _unquote_key(key: str) -> str:
+    # Ключи почти всегда содержат только закодированные скобки
+    if "%5" in key:
+        key = key.replace("%5B", "[").replace("%5D", "]").replace("%5b", "[").replace("%5d", "]")
+    return _unquote(key)
+
+
+def _child(node: Dict[str, Any], name: str) -> Dict[str, Any]:
+    """Вложенный контейнер node[name]; создается, если его еще нет."""
+    child = node.get(name)
+    if not isinstance(child, dict):
+        child = node[name] = {}
+    return child
+
+
+def _as_list(node: Dict[str, Any]) -> Optional[list]:
+    """Значения контейнера с индексами 0..n-1 по порядку; None, если индексы с пропусками или не числа."""
+    if not all(key.isdecimal() for key in node):
+        return None
+    items = sorted((int(key), value) for key, value in node.items())
+    if any(index != position for position, (index, _) in enumerate(items)):
+        return None
+    return [value for _, value in items]
+
+
+def parse_form(body: bytes) -> Dict[str, Any]:
+    """
+    Разбирает urlencoded-тело за один проход в вложенные структуры в стиле PHP:
+    a=1 -> {"a": "1"}, auth[domain]=x -> {"auth": {"domain": "x"}},
+    document_id[0]=crm / document_id[]=crm -> {"document_id": ["crm"]}.
+    Значения попадают на место своего индекса; индексы с пропусками (p[0]=a&p[5]=b)
+    дают словарь {"0": "a", "5": "b"}, а не список.
+    """
+    result: Dict[str, Any] = {}
+    # Контейнеры с числовыми индексами: следующий индекс для "[]" (как в PHP: максимальный + 1)
+    # и место контейнера в родителе, чтобы после разбора заменить его списком
+    next_index: Dict[int, int] = {}
+    indexed: List[Tuple[Dict[str, Any], str, Dict[str, Any]]] = []
+    for pair in body.decode("latin-1").split("&"):
+        if not pair:
+            continue
+        raw_key, _, raw_value = pair.partition("=")
+        key = _unquote_key(raw_key)
+        value = _unquote(raw_value)
+
+        bracket = key.find("[")
+        if bracket <= 0 or not key.endswith("]"):
+            result[key] = value
+            continue
+
+        node, name = result, key[:bracket]
+        for part in key[bracket + 1:-1].split("]["):
+            parent, node = node, _child(node, name)
+            if not part or part.isdecimal():
+                index = next_index.get(id(node))
+                if index is None:
+                    index = 0
+                    indexed.append((parent, name, node))
+                if not part:
+                    part = str(index)
+                next_index[id(node)] = max(index, int(part) + 1)
+            name = part
+        node[name] = value
+
+    # Вложенные контейнеры добавлены позже родителей: обходим с конца, чтобы сначала заменить их
+    for parent, name, node in reversed(indexed):
+        if parent.get(name) is node:
+            items = _as_list(node)
+            if items is not None:
+                parent[name] = items
+    return result
+
+
+def parse_robot_call(body: bytes) -> RobotCallPayload:
+    """Разбирает тело вызова робота в типизированную структуру."""
+    form = parse_form(body)
+
+    auth_raw = form.get("auth")
+    auth = {}
+    if isinstance(auth_raw, dict):
+        for key, value in auth_raw.items():
+            if key in _AUTH_FIELDS:
+                auth[key] = _to_int(value) if key in _INT_AUTH_FIELDS else _str(value)
+
+    # model_construct не проверяет типы: все, что не совпадает со схемой, отбрасываем здесь
+    properties = form.get("properties")
+    document_id = form.get("document_id")
+    document_type = form.get("document_type")
+    return RobotCallPayload.model_construct(
+        event_token=_str(form.get("event_token")),
+        properties={k: v for k, v in properties.items() if isinstance(v, str)} if isinstance(properties, dict) else {},
+        auth=RobotAuth.model_construct(**auth),
+        document_id=[v for v in document_id if isinstance(v, str)] if isinstance(document_id, list) else [],
+        document_type=[v for v in document_type if isinstance(v, str)] if isinstance(document_type, list) else [],
+        ts=_to_int(form.get("ts"))
+    )
+
+
+def is_application_token_allowed(application_token: Optional[str]) -> bool:
+    """
+    Проверка auth[application_token] по ALLOWED_EVENT_TOKEN.
+    Пустой ALLOWED_EVENT_TOKEN отключает проверку.
+    """
+    if not settings.ALLOWED_EVENT_TOKEN:
+        return True
+    if not application_token:
+        return False
+    return hmac.compare_digest(application_token.encode(), settings.ALLOWED_EVENT_TOKEN.encode())
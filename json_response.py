@@ -0,0 +1,18 @@
+from typing import Any
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON-ответ, сериализуемый через orjson (если установлен).
+    Без orjson работает как обычный JSONResponse.
+    """
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
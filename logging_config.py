@@ -0,0 +1,218 @@
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import queue
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Awaitable, Dict, Iterator, List, Optional, Tuple
+from config import settings
+from metrics import registry
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Correlation ID текущего запроса; записи получают их в ContextFilter
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+portal_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("portal", default=None)
+event_token_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("event_token", default=None)
+
+CONTEXT_FIELDS = ("request_id", "portal", "event_token")
+
+LOG_RECORDS_DROPPED = registry.counter(
+    "log_records_dropped_total", "Log records dropped before output", ("reason",))
+
+
+def set_log_context(portal: Optional[str] = None, event_token: Optional[str] = None):
+    """Привязывает портал и event_token к записям текущей задачи."""
+    if portal is not None:
+        portal_var.set(portal)
+    if event_token is not None:
+        event_token_var.set(event_token)
+
+
+@contextlib.contextmanager
+def log_context(portal: Optional[str] = None, event_token: Optional[str] = None) -> Iterator[None]:
+    """
+    Привязывает портал и event_token к записям внутри блока (оба значения, в том числе None)
+    и восстанавливает прежние при выходе. Для долгоживущих задач, выполняющих много вызовов подряд.
+    """
+    portal_token = portal_var.set(portal)
+    event_token_token = event_token_var.set(event_token)
+    try:
+        yield
+    finally:
+        event_token_var.reset(event_token_token)
+        portal_var.reset(portal_token)
+
+
+def create_shared_task(coro: Awaitable) -> asyncio.Task:
+    """
+    Задача, которую ждут несколько запросов (общий batch, обновление токена).
+    Запускается в пустом контексте: иначе она унаследовала бы request_id и event_token
+    того запроса, который ее создал, и приписала бы ему записи всех остальных.
+    """
+    return contextvars.Context().run(asyncio.ensure_future, coro)
+
+
+class ContextFilter(logging.Filter):
+    """Копирует correlation ID в запись — в потоке, где вызван логгер, пока контекст еще доступен."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        record.portal = portal_var.get()
+        record.event_token = event_token_var.get()
+        return True
+
+
+class RepeatedErrorFilter(logging.Filter):
+    """
+    Ограничивает поток одинаковых предупреждений и ошибок (ключ — логгер, уровень и шаблон сообщения).
+    За window секунд проходят первые burst записей, дальше — каждая sample-я (0 — ни одной).
+    Первая запись следующего окна сообщает в поле suppressed, сколько было отброшено.
+    """
+    def __init__(self, burst: int, window: float, sample: int):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.sample = sample
+        # ключ -> [начало окна, записей в окне, отброшено]
+        self._windows: Dict[Tuple[str, int, str], List] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+        # Шаблон %-style одинаков для всех повторов, в отличие от готовой f-строки
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        state = self._windows.get(key)
+        if state is None or now - state[0] >= self.window:
+            if state is not None and state[2]:
+                record.suppressed = state[2]
+            if len(self._windows) > 1000:
+                self._prune(now)
+            state = self._windows[key] = [now, 0, 0]
+
+        state[1] += 1
+        over = state[1] - self.burst
+        if over <= 0 or (self.sample and over % self.sample == 0):
+            return True
+        state[2] += 1
+        LOG_RECORDS_DROPPED.inc("rate_limited")
+        return False
+
+    def _prune(self, now: float):
+        for key, state in list(self._windows.items()):
+            if now - state[0] >= self.window:
+                del self._windows[key]
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Передает запись в очередь без форматирования: сообщение, аргументы и traceback
+    форматирует поток QueueListener, а не event loop.
+    Если очередь переполнена (вывод не успевает), запись отбрасывается, а не ждет.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc("queue_full")
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, логгер, сообщение, correlation ID, traceback."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS + ("suppressed",):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+_listener: Optional[QueueListener] = None
+
+
+def setup_logging() -> QueueListener:
+    """
+    Логирование через очередь: логгеры только кладут записи в очередь,
+    форматирование и запись в консоль/файл идут в отдельном потоке.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    output = logging.FileHandler(settings.LOG_FILE, encoding="utf-8") if settings.LOG_FILE \
+        else logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if settings.LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+
+    handler = NonBlockingQueueHandler(queue.Queue(settings.LOG_QUEUE_SIZE))
+    handler.addFilter(ContextFilter())
+    if settings.LOG_ERROR_BURST > 0:
+        handler.addFilter(RepeatedErrorFilter(settings.LOG_ERROR_BURST, settings.LOG_ERROR_WINDOW,
+                                              settings.LOG_ERROR_SAMPLE))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(settings.LOG_LEVEL.upper())
+    # uvicorn пишет свои логи синхронно в собственные handler-ы; направляем их в общую очередь
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers.clear()
+        uvicorn_logger.propagate = True
+
+    _listener = QueueListener(handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """Дописывает накопленные записи и останавливает поток вывода."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class RequestContextMiddleware:
+    """ASGI middleware: request_id (из X-Request-ID или новый) для логов и заголовка ответа."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex[:16]
+        token = request_id_var.set(request_id)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(token)
@@ -1,17 +1,55 @@
-import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from config import settings
+from json_response import FastJSONResponse
+from logging_config import RequestContextMiddleware, setup_logging
+from metrics import MetricsMiddleware
+from dependencies import http_pool, token_repository, job_queue, job_workers, idempotency_guard, contact_index
+from repositories.sqlite_token_store import SqliteTokenRepository
+from services.contact_import import cancel_imports
 from router import router
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
+# Логи пишутся из отдельного потока, обработчики запросов только кладут записи в очередь
+setup_logging()
 
-app = FastAPI(title="Bitrix24 Robot Integration")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Один HTTP-клиент на всё время жизни приложения
+    await http_pool.start()
+    if isinstance(token_repository, SqliteTokenRepository):
+        await token_repository.migrate_from_json(settings.TOKENS_FILE)
+    if settings.IDEMPOTENCY_ENABLED:
+        await idempotency_guard.init()
+    if settings.CONTACT_DEDUP_ENABLED:
+        await contact_index.init()
+    if settings.ROBOT_ASYNC_MODE:
+        await job_queue.init()
+        job_workers.start()
+    try:
+        yield
+    finally:
+        # Прерванные импорты продолжаются с checkpoint: python cli.py import-contacts IMPORT_DIR/<id>.<fmt> --domain ...
+        await cancel_imports()
+        if settings.ROBOT_ASYNC_MODE:
+            await job_workers.stop()
+            await job_queue.close()
+        if settings.IDEMPOTENCY_ENABLED:
+            await idempotency_guard.close()
+        if settings.CONTACT_DEDUP_ENABLED:
+            await contact_index.close()
+        await http_pool.close()
+        if isinstance(token_repository, SqliteTokenRepository):
+            await token_repository.close()
+
+
+app = FastAPI(title="Bitrix24 Robot Integration", lifespan=lifespan, default_response_class=FastJSONResponse)
+
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(RequestContextMiddleware)
 app.include_router(router)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Логирование настраивает приложение (setup_logging), а не uvicorn
+    uvicorn.run(app, host=settings.SERVER_HOST, port=settings.SERVER_PORT, log_config=None)
\ No newline at end of file
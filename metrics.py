@@ -0,0 +1,200 @@
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Границы корзин гистограмм задержек (секунды)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """
+    Монотонный счетчик. Без блокировок: все обновления идут из одного event loop,
+    а словарь и числа меняются атомарно под GIL.
+    """
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in list(self._values.items())]
+
+
+class Gauge(_Metric):
+    """Текущее значение; либо выставляется напрямую, либо считается функцией в момент сбора."""
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 collect: Callable[[], Dict[Labels, float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Labels, float] = {}
+        self._collect = collect
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def dec(self, *labels: str, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) - amount
+
+    def render(self) -> List[str]:
+        values = self._collect() if self._collect else self._values
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in list(values.items())]
+
+
+class Histogram(_Metric):
+    """
+    Гистограмма с фиксированными корзинами.
+    observe() — это bisect и два инкремента; накопительные суммы считаются только при сборе.
+    """
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [счетчики корзин (+Inf последним), сумма]
+        self._series: Dict[Labels, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, *labels: str):
+        """Декоратор для async-функций: пишет длительность вызова."""
+        def decorator(fn):
+            @wraps(fn)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - started, *labels)
+            return wrapper
+        return decorator
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+              collect: Callable[[], Dict[Labels, float]] = None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, collect))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus (text/plain; version=0.0.4)."""
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+HTTP_REQUEST_DURATION = registry.histogram(
+    "http_request_duration_seconds", "Handler latency by route and status", ("method", "route", "status"))
+BITRIX_REST_DURATION = registry.histogram(
+    "bitrix_rest_duration_seconds", "Bitrix REST call latency including retries", ("method", "portal"))
+BITRIX_REST_ERRORS = registry.counter(
+    "bitrix_rest_errors_total", "Failed Bitrix REST calls", ("method", "portal", "kind"))
+TOKEN_REPOSITORY_DURATION = registry.histogram(
+    "token_repository_duration_seconds", "Token repository operation latency", ("store", "operation"))
+ROBOT_IN_FLIGHT = registry.gauge(
+    "robot_executions_in_flight", "Robot executions currently in progress")
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware: латентность обработчиков по шаблону маршрута и статусу.
+    Шаблон (а не фактический путь) держит число временных рядов ограниченным.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = "500"
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - started,
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                status
+            )
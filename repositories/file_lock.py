@@ -0,0 +1,66 @@
+import asyncio
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLockTimeout(Exception):
+    """Блокировку не удалось получить за отведенное время."""
+
+
+class FileLock:
+    """
+    Межпроцессная блокировка на lock-файле (fcntl.flock, на Windows — msvcrt.locking).
+    Используется как `async with FileLock(path):`; один объект — одно удержание.
+    - Ожидание — неблокирующие попытки с паузой, поэтому event loop не занимается.
+    - Если процесс-владелец упал, блокировку снимает ОС.
+    """
+    def __init__(self, path: str, timeout: float = 30.0, poll_interval: float = 0.01):
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._fd = None
+
+    @staticmethod
+    def _try_lock(fd: int) -> bool:
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def _unlock(fd: int):
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+    async def __aenter__(self) -> "FileLock":
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + self.timeout
+        delay = self.poll_interval
+        while not self._try_lock(fd):
+            if time.monotonic() >= deadline:
+                os.close(fd)
+                raise FileLockTimeout(f"Could not lock {self.path} in {self.timeout}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        self._fd = fd
+        return self
+
+    async def __aexit__(self, *exc):
+        fd, self._fd = self._fd, None
+        try:
+            self._unlock(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,45 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional
+
+class SQLiteDatabase:
+    """
+    Встроенная база SQLite в режиме WAL.
+    Все обращения выполняются в отдельном потоке (по одному на базу),
+    поэтому не блокируют event loop и не требуют блокировок вокруг соединения.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"sqlite-{path}")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._conn = conn
+        return self._conn
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """Выполняет fn(connection, *args) в потоке базы."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: fn(self._connection(), *args))
+
+    async def execute(self, sql: str, params: Iterable = ()) -> List[sqlite3.Row]:
+        return await self.run(lambda conn: conn.execute(sql, tuple(params)).fetchall())
+
+    async def executescript(self, script: str):
+        await self.run(lambda conn: conn.executescript(script))
+
+    async def close(self):
+        def _close(conn: sqlite3.Connection):
+            conn.close()
+            self._conn = None
+
+        if self._conn is not None:
+            await self.run(_close)
+        self._executor.shutdown(wait=False)
\ No newline at end of file
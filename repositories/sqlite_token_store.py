@@ -0,0 +1,200 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+from metrics import TOKEN_REPOSITORY_DURATION
+from .file_lock import FileLock
+from .sqlite_db import SQLiteDatabase
+from .token_store import ITokenRepository, JsonTokenRepository
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    domain TEXT PRIMARY KEY,
+    member_id TEXT,
+    application_token TEXT,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_tokens_member_id ON tokens(member_id);
+CREATE INDEX IF NOT EXISTS ix_tokens_application_token ON tokens(application_token);
+"""
+
+# Запас при дочитывании чужих изменений: updated_at вычисляется до фиксации транзакции
+SYNC_OVERLAP = 60.0
+
+
+class SqliteTokenRepository(ITokenRepository):
+    """
+    Хранилище токенов для множества порталов (SQLite, WAL).
+    load() без domain / member_id / application_token ничего не находит.
+    Все записи держатся в памяти в словарях по domain / member_id / application_token,
+    поэтому поиск — O(1) и без обращения к диску; база нужна для надежного хранения.
+    Записи других процессов (несколько воркеров) подхватываются не чаще раза в
+    check_interval секунд: PRAGMA data_version показывает, менял ли кто-то базу.
+    """
+    def __init__(self, db_path: str, check_interval: float = 1.0):
+        self.db = SQLiteDatabase(db_path)
+        self.check_interval = check_interval
+        self._by_domain: Dict[str, dict] = {}
+        self._by_member: Dict[str, dict] = {}
+        self._by_app_token: Dict[str, dict] = {}
+        self._loaded = False
+        self._data_version: Optional[int] = None
+        self._synced_until = 0.0
+        self._checked_at = 0.0
+
+    async def init(self):
+        if self._loaded:
+            return
+        await self.db.executescript(SCHEMA)
+        await self._sync()
+        self._loaded = True
+        logger.info("Loaded tokens for %s portal(s) from %s", len(self._by_domain), self.db.path)
+
+    def lock(self, domain: Optional[str] = None) -> FileLock:
+        if domain is None:
+            return FileLock(f"{self.db.path}.lock")
+        # Отдельный lock-файл на портал; имя — хэш домена, чтобы домен не превращался в путь
+        lock_dir = f"{self.db.path}.locks"
+        os.makedirs(lock_dir, exist_ok=True)
+        name = hashlib.sha1(domain.lower().encode()).hexdigest()[:20]
+        return FileLock(os.path.join(lock_dir, f"{name}.lock"))
+
+    async def sync(self):
+        await self.init()
+        await self._sync()
+
+    async def _sync(self):
+        self._checked_at = time.monotonic()
+
+        def _changes(conn, version, since):
+            current = conn.execute("PRAGMA data_version").fetchone()[0]
+            if current == version:
+                return current, []
+            rows = conn.execute(
+                "SELECT data, updated_at FROM tokens WHERE updated_at >= ? ORDER BY updated_at", (since,)
+            ).fetchall()
+            return current, rows
+
+        self._data_version, rows = await self.db.run(
+            _changes, self._data_version, self._synced_until - SYNC_OVERLAP)
+        for row in rows:
+            self._index(json.loads(row["data"]))
+            self._synced_until = max(self._synced_until, row["updated_at"])
+
+    async def _maybe_sync(self):
+        if not self._loaded:
+            await self.init()
+        elif time.monotonic() - self._checked_at >= self.check_interval:
+            await self._sync()
+
+    def _index(self, tokens: dict):
+        old = self._by_domain.get(tokens["domain"])
+        if old is not None:
+            self._unindex(old)
+        self._by_domain[tokens["domain"]] = tokens
+        if tokens.get("member_id"):
+            stale = self._by_member.get(tokens["member_id"])
+            if stale is not None and stale["domain"] != tokens["domain"]:
+                # Портал сменил домен: старая запись больше не нужна
+                self._unindex(stale)
+                self._by_domain.pop(stale["domain"], None)
+            self._by_member[tokens["member_id"]] = tokens
+        if tokens.get("application_token"):
+            self._by_app_token[tokens["application_token"]] = tokens
+
+    def _unindex(self, tokens: dict):
+        if tokens.get("member_id") and self._by_member.get(tokens["member_id"]) is tokens:
+            del self._by_member[tokens["member_id"]]
+        if tokens.get("application_token") and self._by_app_token.get(tokens["application_token"]) is tokens:
+            del self._by_app_token[tokens["application_token"]]
+
+    @TOKEN_REPOSITORY_DURATION.time("sqlite", "save")
+    async def save(self, data: dict):
+        if not data.get("domain"):
+            raise ValueError("Tokens without domain can not be stored")
+        await self.init()
+
+        tokens = dict(data)
+        updated_at = time.time()
+        params = (
+            tokens["domain"],
+            tokens.get("member_id"),
+            tokens.get("application_token"),
+            json.dumps(tokens, ensure_ascii=False),
+            updated_at
+        )
+
+        def _upsert(conn):
+            with conn:
+                if tokens.get("member_id"):
+                    conn.execute("DELETE FROM tokens WHERE member_id = ? AND domain != ?",
+                                 (tokens["member_id"], tokens["domain"]))
+                conn.execute(
+                    "INSERT INTO tokens (domain, member_id, application_token, data, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(domain) DO UPDATE SET member_id = excluded.member_id, "
+                    "application_token = excluded.application_token, data = excluded.data, "
+                    "updated_at = excluded.updated_at",
+                    params
+                )
+
+        await self.db.run(_upsert)
+        self._index(tokens)
+        self._synced_until = max(self._synced_until, updated_at)
+
+    @TOKEN_REPOSITORY_DURATION.time("sqlite", "load")
+    async def load(self, domain: Optional[str] = None, member_id: Optional[str] = None,
+                   application_token: Optional[str] = None) -> Optional[dict]:
+        await self._maybe_sync()
+        tokens = self._lookup(domain, member_id, application_token)
+        if tokens is None:
+            # Портал мог только что установиться через другой воркер
+            await self._sync()
+            tokens = self._lookup(domain, member_id, application_token)
+        return dict(tokens) if tokens is not None else None
+
+    def _lookup(self, domain: Optional[str], member_id: Optional[str],
+                application_token: Optional[str]) -> Optional[dict]:
+        if domain or member_id:
+            # Если портал сменил домен, найдем его по member_id
+            tokens = self._by_domain.get(domain) if domain else None
+            if tokens is None and member_id:
+                tokens = self._by_member.get(member_id)
+        elif application_token:
+            tokens = self._by_app_token.get(application_token)
+        else:
+            # Порталов много: без фильтра нельзя выбрать, чьи токены отдавать
+            return None
+        if tokens is None:
+            return None
+        if member_id and tokens.get("member_id") not in (None, member_id):
+            return None
+        return tokens
+
+    async def load_all(self) -> List[dict]:
+        await self._maybe_sync()
+        return [dict(t) for t in self._by_domain.values()]
+
+    async def migrate_from_json(self, file_path: str):
+        """
+        Одноразовый перенос токенов из tokens.json.
+        После переноса файл переименовывается в *.migrated, чтобы не импортировать его повторно.
+        """
+        # Воркеры стартуют одновременно: переносит тот, кто первым взял блокировку
+        async with self.lock():
+            await self.sync()
+            tokens = await JsonTokenRepository(file_path).load()
+            if not tokens:
+                return
+            if tokens.get("domain") and tokens["domain"] not in self._by_domain:
+                await self.save(tokens)
+                logger.info("Migrated tokens for %s from %s", tokens["domain"], file_path)
+            os.replace(file_path, f"{file_path}.migrated")
+
+    async def close(self):
+        await self.db.close()
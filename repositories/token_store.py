@@ -1,8 +1,14 @@
+import asyncio
 import json
 import os
+import tempfile
+import time
 import aiofiles
 from abc import ABC, abstractmethod
-from typing import Optional
+from contextlib import nullcontext
+from typing import List, Optional, Tuple
+from metrics import TOKEN_REPOSITORY_DURATION
+from .file_lock import FileLock
 
 class ITokenRepository(ABC):
     """
@@ -14,18 +20,66 @@ class ITokenRepository(ABC):
         pass
 
     @abstractmethod
-    async def load(self) -> Optional[dict]:
+    async def load(self, domain: Optional[str] = None, member_id: Optional[str] = None,
+                   application_token: Optional[str] = None) -> Optional[dict]:
+        """
+        Токены портала с указанным domain / member_id / application_token.
+        Без фильтров хранилище одного портала (JSON) возвращает его токены,
+        хранилище множества порталов — None.
+        """
         pass
 
+    async def load_all(self) -> List[dict]:
+        """Токены всех известных порталов."""
+        tokens = await self.load()
+        return [tokens] if tokens else []
+
+    def lock(self, domain: Optional[str] = None):
+        """
+        Блокировка для последовательностей "прочитать — изменить — записать"
+        (обновление токена, слияние полей портала), общая для всех процессов приложения.
+        С domain блокируется только этот портал: обновление токена одного портала
+        не задерживает остальные.
+        """
+        return nullcontext()
+
+    async def sync(self):
+        """Подхватывает изменения, сделанные другими процессами, до следующего load()."""
+
+def token_matches(tokens: dict, domain: Optional[str] = None, member_id: Optional[str] = None,
+                  application_token: Optional[str] = None) -> bool:
+    if domain and tokens.get("domain") != domain:
+        return False
+    # Токены, сохраненные до появления member_id, подходят любому member_id
+    if member_id and tokens.get("member_id") not in (None, member_id):
+        return False
+    if application_token and tokens.get("application_token") != application_token:
+        return False
+    return True
+
 class JsonTokenRepository(ITokenRepository):
+    """Хранит токены одного портала в JSON-файле."""
     def __init__(self, file_path: str):
         self.file_path = file_path
 
+    def lock(self, domain: Optional[str] = None) -> FileLock:
+        # Портал один, а файл записывается целиком: блокировка всегда общая
+        return FileLock(f"{self.file_path}.lock")
+
+    @TOKEN_REPOSITORY_DURATION.time("json", "save")
     async def save(self, data: dict):
-        async with aiofiles.open(self.file_path, "w", encoding="utf-8") as f:
-            await f.write(json.dumps(data, indent=4, ensure_ascii=False))
+        content = json.dumps(data, indent=4, ensure_ascii=False)
+        await asyncio.to_thread(self._write_atomic, content)
+
+    @TOKEN_REPOSITORY_DURATION.time("json", "load")
+    async def load(self, domain: Optional[str] = None, member_id: Optional[str] = None,
+                   application_token: Optional[str] = None) -> Optional[dict]:
+        tokens = await self._read()
+        if tokens is None or not token_matches(tokens, domain, member_id, application_token):
+            return None
+        return tokens
 
-    async def load(self) -> Optional[dict]:
+    async def _read(self) -> Optional[dict]:
         if not os.path.exists(self.file_path):
             return None
         try:
@@ -33,4 +87,110 @@ class JsonTokenRepository(ITokenRepository):
                 content = await f.read()
                 return json.loads(content)
         except (json.JSONDecodeError, OSError):
-            return None
\ No newline at end of file
+            return None
+
+    def _write_atomic(self, content: str):
+        """
+        Запись через временный файл + rename: читатель видит либо старый,
+        либо новый файл целиком, но никогда не половину записи.
+        Имя временного файла уникально, поэтому одновременные записи не портят друг другу файл.
+        """
+        directory, name = os.path.split(os.path.abspath(self.file_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f"{name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+class CachedJsonTokenRepository(JsonTokenRepository):
+    """
+    JSON-хранилище с кэшем в памяти.
+    - load() отдает токены из памяти; файл перечитывается, только если изменились
+      его mtime/inode/размер (проверка не чаще, чем раз в check_interval секунд).
+    - save() сразу обновляет память, а запись на диск откладывает на save_delay секунд,
+      объединяя серию сохранений в одну атомарную запись.
+    """
+    def __init__(self, file_path: str, check_interval: float = 1.0, save_delay: float = 0.05):
+        super().__init__(file_path)
+        self.check_interval = check_interval
+        self.save_delay = save_delay
+        self._data: Optional[dict] = None
+        self._file_key: Optional[Tuple[int, int, int]] = None
+        self._checked_at = 0.0
+        self._flush: Optional[asyncio.Future] = None
+        # Следующая запись ждет окончания предыдущей: иначе более старые данные могли бы лечь поверх новых
+        self._write_lock = asyncio.Lock()
+        # Растет при каждом save(): чтение файла, начатое до сохранения, не должно его затереть
+        self._version = 0
+
+    def _stat_key(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(self.file_path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_ino, st.st_size
+
+    async def sync(self):
+        # Следующий _read() сверит файл с кэшем, не дожидаясь check_interval
+        self._checked_at = 0.0
+
+    async def load(self, domain: Optional[str] = None, member_id: Optional[str] = None,
+                   application_token: Optional[str] = None) -> Optional[dict]:
+        tokens = await super().load(domain, member_id, application_token)
+        if tokens is None and self._flush is None:
+            # Портал мог только что установиться через другой воркер
+            await self.sync()
+            tokens = await super().load(domain, member_id, application_token)
+        return tokens
+
+    async def _read(self) -> Optional[dict]:
+        # Пока есть неотписанные изменения, память — источник истины
+        if self._flush is not None:
+            return dict(self._data) if self._data is not None else None
+
+        now = time.monotonic()
+        if self._data is not None and now - self._checked_at < self.check_interval:
+            return dict(self._data)
+        self._checked_at = now
+
+        key = self._stat_key()
+        if key is None:
+            self._data, self._file_key = None, None
+            return None
+        if key != self._file_key or self._data is None:
+            version = self._version
+            data = await super()._read()
+            if version == self._version:
+                self._data, self._file_key = data, key
+
+        return dict(self._data) if self._data is not None else None
+
+    @TOKEN_REPOSITORY_DURATION.time("json", "save")
+    async def save(self, data: dict):
+        self._data = dict(data)
+        self._version += 1
+        if self._flush is None:
+            self._flush = asyncio.get_running_loop().create_future()
+            asyncio.create_task(self._flush_later(self._flush))
+        # shield: отмена одного вызывающего не должна отменять общую запись
+        await asyncio.shield(self._flush)
+
+    async def _flush_later(self, flush: asyncio.Future):
+        await asyncio.sleep(self.save_delay)
+        # Все save(), пришедшие до этого момента, попадут в одну запись
+        self._flush = None
+        try:
+            content = json.dumps(self._data, indent=4, ensure_ascii=False)
+            async with self._write_lock:
+                await asyncio.to_thread(self._write_atomic, content)
+                self._file_key = self._stat_key()
+                self._checked_at = time.monotonic()
+            flush.set_result(None)
+        except Exception as e:
+            flush.set_exception(e)
\ No newline at end of file
@@ -1,12 +1,22 @@
 from fastapi import APIRouter, Request, Depends
-from fastapi.responses import RedirectResponse, PlainTextResponse, JSONResponse
+from fastapi.responses import RedirectResponse, PlainTextResponse
+import aiofiles
+import hmac
 import httpx
 import logging
+import os
 
 from config import settings
-from dependencies import get_repository, get_robot_service, get_http_client
+from dependencies import (get_repository, get_robot_service, get_http_client, http_pool, job_queue,
+                          idempotency_guard, process_robot_call)
 from services.processing import RobotService
+from services.rate_limiter import rate_limiter_stats
+from services.contact_import import import_paths, import_status, new_import_id, start_import
 from schemas import ContactCreateDTO
+from form_parser import parse_robot_call, is_application_token_allowed
+from json_response import FastJSONResponse
+from logging_config import set_log_context
+from metrics import registry
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -42,16 +52,29 @@ async def oauth_callback(
 
     resp = await http_client.post(token_url, data=payload)
     if resp.status_code != 200:
-        return JSONResponse({"error": resp.text}, status_code=400)
+        return FastJSONResponse({"error": resp.text}, status_code=400)
 
     token_data = resp.json()
-    await repo.save(token_data)
+    # Домен и member_id портала Битрикс передает в параметрах callback-а
+    # (domain в ответе OAuth-сервера — это oauth.bitrix.info)
+    for key in ("domain", "member_id"):
+        if request.query_params.get(key):
+            token_data[key] = request.query_params[key]
+    # Сохраняем ранее записанные поля портала (например, хэш регистрации робота)
+    async with repo.lock(token_data.get("domain")):
+        await repo.sync()
+        existing = await repo.load(domain=token_data.get("domain")) or {}
+        await repo.save({**existing, **token_data})
 
     # ДЕЛЕГИРОВАНИЕ: Роутер просто просит сервис "установи робота"
+    # Callback приходит при (пере)установке приложения: сохраненный хэш регистрации мог остаться
+    # от удаленной установки, поэтому не доверяем ему (уже зарегистрированный робот обновится)
+    robot_status = None
     if "domain" in token_data:
-        await service.install_robot(token_data["domain"], token_data["access_token"])
+        robot_status = await service.install_robot(token_data["domain"], token_data["access_token"],
+                                                   fresh_install=True)
 
-    return JSONResponse({"status": "installed"})
+    return FastJSONResponse({"status": "installed", "robot": robot_status})
 
 
 @router.post("/bitrix/oauth/install")
@@ -60,25 +83,37 @@ async def install_app_event(
         repo=Depends(get_repository),
         service: RobotService = Depends(get_robot_service)
 ):
-    form = await request.form()
-    data = dict(form)
-    auth_data = {k: v for k, v in data.items() if k.startswith("auth[")}
+    auth = parse_robot_call(await request.body()).auth
 
-    access_token = auth_data.get("auth[access_token]")
-    domain = auth_data.get("auth[domain]")
+    access_token = auth.access_token
+    domain = auth.domain
+    set_log_context(portal=domain)
 
     if not access_token:
-        return JSONResponse({"error": "No token"}, status_code=400)
+        return FastJSONResponse({"error": "No token"}, status_code=400)
 
-    await repo.save({
+    tokens = {
         "access_token": access_token,
-        "refresh_token": auth_data.get("auth[refresh_token]"),
-        "domain": domain
-    })
+        "refresh_token": auth.refresh_token,
+        "domain": domain,
+        "member_id": auth.member_id,
+        "application_token": auth.application_token
+    }
+    # expires нужен для заблаговременного обновления токена
+    if auth.expires:
+        tokens["expires"] = auth.expires
+
+    # При каждой установке приложения Битрикс выдает новый application_token:
+    # значит, прежней регистрации робота на портале уже нет
+    async with repo.lock(domain):
+        await repo.sync()
+        existing = await repo.load(domain=domain) or {}
+        fresh_install = existing.get("application_token") != tokens["application_token"]
+        await repo.save({**existing, **tokens})
 
-    await service.install_robot(domain, access_token)
+    robot_status = await service.install_robot(domain, access_token, fresh_install=fresh_install)
 
-    return JSONResponse({"status": "installed"})
+    return FastJSONResponse({"status": "installed", "robot": robot_status})
 
 
 @router.post("/api/bitrix24")
@@ -86,33 +121,134 @@ async def robot_handler(request: Request, service: RobotService = Depends(get_ro
     """
         Основной обработчик робота (Handler URL).
     Этот эндпоинт вызывает сам Бизнес-процесс Битрикса, когда доходит до шага с роботом.
-    Принимает параметры (имя, телефон и т.д.) в формате form-data.
+    Принимает параметры (имя, телефон и т.д.) в формате application/x-www-form-urlencoded.
     """
-    form = await request.form()
-    event_token = form.get("event_token")
+    call = parse_robot_call(await request.body())
+
+    # Чужие вызовы отсекаем до любой работы с токенами и порталом
+    if not is_application_token_allowed(call.auth.application_token):
+        return PlainTextResponse("Forbidden", status_code=403)
+
+    event_token = call.event_token
+    set_log_context(portal=call.auth.domain, event_token=event_token)
 
     if not event_token:
         return PlainTextResponse("Token missing", status_code=400)
 
+    domain = call.auth.domain
+    member_id = call.auth.member_id
+    # Без них нельзя определить портал: токены другого портала использовать нельзя
+    if not domain and not member_id:
+        return PlainTextResponse("Error: auth[domain] or auth[member_id] required", status_code=400)
+
+    properties = call.properties
     contact_dto = ContactCreateDTO(
-        last_name=form.get("properties[LAST_NAME]", ""),
-        first_name=form.get("properties[NAME]", ""),
-        second_name=form.get("properties[SECOND_NAME]"),
-        phone=form.get("properties[PHONE]"),
-        email=form.get("properties[EMAIL]")
+        last_name=properties.get("LAST_NAME", ""),
+        first_name=properties.get("NAME", ""),
+        second_name=properties.get("SECOND_NAME"),
+        phone=properties.get("PHONE"),
+        email=properties.get("EMAIL")
     )
 
     if not contact_dto.last_name:
         return PlainTextResponse("Error: LAST_NAME required", status_code=400)
 
+    if settings.ROBOT_ASYNC_MODE:
+        # Робот зарегистрирован с USE_SUBSCRIPTION=Y: результат отправит воркер очереди
+        await job_queue.enqueue(event_token, {
+            "event_token": event_token,
+            "contact": contact_dto.model_dump(),
+            "domain": domain,
+            "member_id": member_id
+        })
+        return PlainTextResponse("OK")
+
     try:
-        await service.process_robot_request(event_token, contact_dto)
+        await process_robot_call(service, event_token, contact_dto, domain=domain, member_id=member_id)
         return PlainTextResponse("OK")
     except Exception as e:
-        logger.error(f"Handler error: {e}", exc_info=True)
+        logger.error("Handler error: %s", e, exc_info=True)
         return PlainTextResponse(f"Error: {str(e)}", status_code=500)
 
 
 @router.get("/api/bitrix24")
 async def robot_check():
-    return JSONResponse({"result": "pong"})
\ No newline at end of file
+    return FastJSONResponse({"result": "pong"})
+
+
+@router.get("/metrics")
+async def metrics():
+    """Метрики в формате Prometheus."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/api/http-pool")
+async def http_pool_stats():
+    """Состояние общего пула HTTP-соединений к порталам."""
+    return FastJSONResponse(http_pool.stats())
+
+
+@router.get("/api/rate-limits")
+async def rate_limits():
+    """Состояние лимитеров запросов по порталам."""
+    return FastJSONResponse(rate_limiter_stats())
+
+
+@router.get("/api/idempotency/stats")
+async def idempotency_stats():
+    """Счетчики попаданий/промахов защиты от повторных вызовов робота."""
+    return FastJSONResponse({"enabled": settings.IDEMPOTENCY_ENABLED, **idempotency_guard.stats()})
+
+
+@router.get("/api/jobs/stats")
+async def job_queue_stats():
+    """Глубина очереди задач робота и возраст самой старой задачи."""
+    if not settings.ROBOT_ASYNC_MODE:
+        return FastJSONResponse({"enabled": False})
+    return FastJSONResponse({"enabled": True, **await job_queue.stats()})
+
+
+def _import_key_valid(request: Request) -> bool:
+    if not settings.IMPORT_API_KEY:
+        return False
+    return hmac.compare_digest(request.headers.get("X-Import-Key", ""), settings.IMPORT_API_KEY)
+
+
+@router.post("/api/import/contacts")
+async def import_contacts(
+        request: Request,
+        domain: str,
+        format: str = "csv",
+        service: RobotService = Depends(get_robot_service)
+):
+    """
+    Массовый импорт контактов в портал. Тело запроса — CSV с заголовком или JSONL.
+    Файл потоково сохраняется в IMPORT_DIR, импорт идет в фоне;
+    состояние — GET /api/import/contacts/{id}. Требует заголовок X-Import-Key.
+    """
+    if not _import_key_valid(request):
+        return PlainTextResponse("Forbidden", status_code=403)
+    if format not in ("csv", "jsonl"):
+        return FastJSONResponse({"error": "format must be csv or jsonl"}, status_code=400)
+    if await service.repo.load(domain=domain) is None:
+        return FastJSONResponse({"error": f"Unknown portal {domain}"}, status_code=404)
+
+    import_id = new_import_id()
+    os.makedirs(settings.IMPORT_DIR, exist_ok=True)
+    async with aiofiles.open(import_paths(import_id, format)["source"], "wb") as f:
+        async for chunk in request.stream():
+            await f.write(chunk)
+
+    start_import(service, domain, import_id, format)
+    return FastJSONResponse({"id": import_id, "status": "running"}, status_code=202)
+
+
+@router.get("/api/import/contacts/{import_id}")
+async def import_contacts_status(import_id: str, request: Request):
+    """Прогресс импорта: обработанные строки, счетчики по статусам, скорость."""
+    if not _import_key_valid(request):
+        return PlainTextResponse("Forbidden", status_code=403)
+    status = import_status(import_id)
+    if status is None:
+        return FastJSONResponse({"error": "Import not found"}, status_code=404)
+    return FastJSONResponse(status)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 
 class ContactCreateDTO(BaseModel):
     """
@@ -35,4 +35,29 @@ class RobotConfig(BaseModel):
     name: str
     handler_url: str
     properties: Dict[str, RobotProperty]
-    return_properties: Dict[str, RobotProperty]
\ No newline at end of file
+    return_properties: Dict[str, RobotProperty]
+
+class RobotAuth(BaseModel):
+    """
+    Блок auth[...] из вызова робота / события приложения.
+    """
+    access_token: Optional[str] = None
+    refresh_token: Optional[str] = None
+    expires: Optional[int] = None
+    expires_in: Optional[int] = None
+    domain: Optional[str] = None
+    member_id: Optional[str] = None
+    application_token: Optional[str] = None
+    client_endpoint: Optional[str] = None
+    server_endpoint: Optional[str] = None
+
+class RobotCallPayload(BaseModel):
+    """
+    Разобранное тело вызова робота (application/x-www-form-urlencoded).
+    """
+    event_token: Optional[str] = None
+    properties: Dict[str, str] = {}
+    auth: RobotAuth = RobotAuth()
+    document_id: List[str] = []
+    document_type: List[str] = []
+    ts: Optional[int] = None
\ No newline at end of file
@@ -0,0 +1,224 @@
+import asyncio
+import itertools
+import logging
+from typing import Any, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlencode
+from config import settings
+from logging_config import create_shared_task, event_token_var, log_context
+
+logger = logging.getLogger(__name__)
+
+# Команда цепочки: (имя, метод, параметры). Параметры могут ссылаться на результат
+# предыдущей команды той же цепочки строкой "$result[имя]".
+Command = Tuple[str, str, dict]
+
+
+class BitrixBatchError(Exception):
+    """Ошибка отдельной команды внутри batch-запроса."""
+    def __init__(self, method: str, error: Any):
+        self.method = method
+        self.error = error
+        super().__init__(f"Bitrix batch command {method} failed: {error}")
+
+
+def build_query(params: dict) -> str:
+    """Кодирует параметры так же, как PHP http_build_query (fields[NAME]=..., PHONE[0][VALUE]=...)."""
+    pairs: List[Tuple[str, str]] = []
+
+    def walk(prefix: str, value: Any):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                walk(f"{prefix}[{k}]" if prefix else str(k), v)
+        elif isinstance(value, (list, tuple)):
+            for i, v in enumerate(value):
+                walk(f"{prefix}[{i}]", v)
+        elif value is None:
+            pairs.append((prefix, ""))
+        elif isinstance(value, bool):
+            pairs.append((prefix, "1" if value else "0"))
+        else:
+            pairs.append((prefix, str(value)))
+
+    walk("", params)
+    return urlencode(pairs)
+
+
+def encode_command(method: str, params: dict) -> str:
+    """Команда batch.json: "метод?параметры"."""
+    query = build_query(params)
+    return f"{method}?{query}" if query else method
+
+
+def parse_batch_response(response: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Returns:
+        tuple: (ключ команды -> result, ключ команды -> ошибка).
+    """
+    body = response.get("result") or {}
+    results = body.get("result") or {}
+    errors = body.get("result_error") or {}
+    # Пустые результаты PHP отдает списком, а не объектом
+    if isinstance(results, list):
+        results = {}
+    if isinstance(errors, list):
+        errors = {}
+    return results, errors
+
+
+def resolve_references(params: Any, results: Dict[str, Any]) -> Any:
+    """Подставляет результаты уже выполненных команд вместо "$result[имя]" (следующая команда цепочки)."""
+    if isinstance(params, dict):
+        return {k: resolve_references(v, results) for k, v in params.items()}
+    if isinstance(params, list):
+        return [resolve_references(v, results) for v in params]
+    if isinstance(params, str) and params.startswith("$result[") and params.endswith("]"):
+        return results.get(params[len("$result["):-1], params)
+    return params
+
+
+def _references(params: Any) -> Set[str]:
+    """Имена команд, на результаты которых ссылаются параметры."""
+    if isinstance(params, dict):
+        return set().union(*map(_references, params.values()))
+    if isinstance(params, list):
+        return set().union(*map(_references, params))
+    if isinstance(params, str) and params.startswith("$result[") and params.endswith("]"):
+        return {params[len("$result["):-1]}
+    return set()
+
+
+def split_stages(commands: List[Command]) -> List[List[Command]]:
+    """
+    Делит цепочку на этапы: команда, ссылающаяся на результат команды текущего этапа,
+    начинает следующий. Этап отправляется только после успешного выполнения предыдущего.
+    """
+    stages: List[List[Command]] = []
+    current: List[Command] = []
+    names: Set[str] = set()
+    for command in commands:
+        if _references(command[2]) & names:
+            stages.append(current)
+            current, names = [], set()
+        current.append(command)
+        names.add(command[0])
+    if current:
+        stages.append(current)
+    return stages
+
+
+class _Group:
+    """Этап цепочки одного вызывающего; в batch попадает целиком."""
+    def __init__(self, client, commands: List[Command], keys: Dict[str, str]):
+        self.client = client
+        self.commands = commands
+        self.keys = keys
+        # Batch отправляется вне контекста вызывающего: event_token нужен для записей о batch
+        self.event_token = event_token_var.get()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class BitrixBatcher:
+    """
+    Микро-батчинг REST-вызовов одного портала.
+    Команды от параллельных обработчиков копятся window секунд (или до max_commands штук)
+    и уходят одним вызовом batch.json; результаты и ошибки раздаются обратно каждому вызывающему.
+    Batch отправляется с halt=0, чтобы ошибка одного вызывающего не отменяла команды других,
+    поэтому команды, зависящие от результата другой команды, ждут следующего batch
+    (ссылка подставляется локально, и при ошибке зависимая команда не отправляется).
+    """
+    def __init__(self, window: float = None, max_commands: int = None):
+        self.window = settings.BITRIX_BATCH_WINDOW if window is None else window
+        self.max_commands = settings.BITRIX_BATCH_MAX_COMMANDS if max_commands is None else max_commands
+        self._pending: List[_Group] = []
+        self._pending_commands = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._seq = itertools.count(1)
+
+    async def submit(self, client, commands: List[Command]) -> Dict[str, Any]:
+        """
+        Ставит цепочку команд в очередь и ждет результаты.
+        Returns:
+            dict: имя команды -> result.
+        """
+        if len(commands) > self.max_commands:
+            raise ValueError(f"Chain of {len(commands)} commands does not fit into a batch of {self.max_commands}")
+
+        results: Dict[str, Any] = {}
+        for stage in split_stages(commands):
+            stage = [(name, method, resolve_references(params or {}, results)) for name, method, params in stage]
+            results.update(await self._submit_stage(client, stage))
+        return results
+
+    async def _submit_stage(self, client, commands: List[Command]) -> Dict[str, Any]:
+        group_id = next(self._seq)
+        keys = {name: f"g{group_id}_{name}" for name, _, _ in commands}
+        group = _Group(client, commands, keys)
+
+        # Этап не разрывается между batch-ами: если не помещается — отправляем накопленное
+        if self._pending_commands + len(commands) > self.max_commands:
+            self._flush()
+        self._pending.append(group)
+        self._pending_commands += len(commands)
+
+        if self._pending_commands >= self.max_commands:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+
+        return await group.future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        groups, self._pending, self._pending_commands = self._pending, [], 0
+        if groups:
+            create_shared_task(self._send(groups))
+
+    async def _send(self, groups: List[_Group]):
+        # Записи общего batch относятся к порталу, а не к одному из вызывающих
+        with log_context(portal=groups[-1].client.domain):
+            await self._send_batch(groups)
+
+    async def _send_batch(self, groups: List[_Group]):
+        event_tokens = [group.event_token for group in groups if group.event_token]
+        cmd = {}
+        for group in groups:
+            for name, method, params in group.commands:
+                cmd[group.keys[name]] = encode_command(method, params)
+
+        # Авторизуемся токеном последнего вызывающего — он самый свежий
+        client = groups[-1].client
+        try:
+            response = await client._post("batch", {"halt": 0, "cmd": cmd})
+        except Exception as e:
+            logger.warning("Batch of %s commands to %s failed for event_tokens %s: %s",
+                           len(cmd), client.domain, event_tokens, e)
+            for group in groups:
+                if not group.future.done():
+                    group.future.set_exception(e)
+            return
+
+        results, errors = parse_batch_response(response)
+        logger.info("Batch of %s commands sent to %s (%s callers, event_tokens %s)",
+                    len(cmd), client.domain, len(groups), event_tokens)
+        for group in groups:
+            if group.future.done():
+                continue
+            failed = next(((method, errors[group.keys[name]]) for name, method, _ in group.commands
+                           if group.keys[name] in errors), None)
+            if failed:
+                group.future.set_exception(BitrixBatchError(*failed))
+            else:
+                group.future.set_result({name: results.get(key) for name, key in group.keys.items()})
+
+
+# Батчеры по доменам порталов (общие на процесс)
+_batchers: Dict[str, BitrixBatcher] = {}
+
+
+def get_batcher(domain: str) -> BitrixBatcher:
+    batcher = _batchers.get(domain)
+    if batcher is None:
+        batcher = _batchers[domain] = BitrixBatcher()
+    return batcher
@@ -1,59 +1,257 @@
+import hashlib
 import httpx
+import json
 import logging
-from typing import Dict, Any, Optional
+import time
+from typing import Awaitable, Callable, Dict, Any, List, Optional, Tuple
 from schemas import RobotConfig
+from config import settings
+from metrics import BITRIX_REST_DURATION, BITRIX_REST_ERRORS
+from .batching import BitrixBatchError, Command, encode_command, get_batcher, parse_batch_response, resolve_references
+from .rate_limiter import RateLimitExceeded, get_rate_limiter, method_priority
 
 logger = logging.getLogger(__name__)
 
+# Колбэк, который обновляет токен и возвращает новый access_token
+TokenRefresher = Callable[[], Awaitable[str]]
+
+
+def build_robot_payload(config: RobotConfig) -> Dict[str, Any]:
+    """Параметры bizproc.robot.add для конфигурации робота."""
+    return {
+        "CODE": config.code,
+        "HANDLER": config.handler_url,
+        "AUTH_USER_ID": 1,
+        "USE_SUBSCRIPTION": "Y",
+        "NAME": config.name,
+        "PROPERTIES": {k: v.model_dump(exclude_none=True) for k, v in config.properties.items()},
+        "RETURN_PROPERTIES": {k: v.model_dump(exclude_none=True) for k, v in config.return_properties.items()},
+        "FILTER": {"INCLUDE": [["crm", "CCrmDocumentDeal"]]}
+    }
+
+
+def payload_fingerprint(payload: Dict[str, Any]) -> str:
+    """Хэш содержимого регистрации робота: совпал — перерегистрировать не нужно."""
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def bitrix_error_code(error: Exception) -> Optional[str]:
+    if isinstance(error, httpx.HTTPStatusError):
+        try:
+            return error.response.json().get("error")
+        except ValueError:
+            return None
+    return None
+
 class BitrixClient:
     """
     Низкоуровневый HTTP-клиент для работы с REST API Bitrix24.
     Отвечает только за отправку запросов и обработку сетевых ошибок
     """
-    def __init__(self, client: httpx.AsyncClient, domain: str, access_token: str):
+    def __init__(self, client: httpx.AsyncClient, domain: str, access_token: str,
+                 token_refresher: Optional[TokenRefresher] = None):
         self.client = client
-        self.base_url = f"https://{domain}/rest"
+        self.domain = domain
+        self.base_url = f"{settings.BITRIX_REST_SCHEME}://{domain}/rest"
         # httpx передает params немного иначе, но логика та же
         self.auth_params = {"auth": access_token}
+        self.token_refresher = token_refresher
+        self.metrics_portal = domain if settings.METRICS_PER_PORTAL else ""
 
-    async def _post(self, method: str, json_data: dict = None) -> Dict[str, Any]:
+    @staticmethod
+    def _is_expired_token(response: httpx.Response) -> bool:
+        if response.status_code != 401:
+            return False
+        try:
+            return response.json().get("error") == "expired_token"
+        except ValueError:
+            return False
+
+    @staticmethod
+    def _is_query_limit(response: httpx.Response) -> bool:
+        if response.status_code != 503:
+            return False
+        try:
+            return response.json().get("error") == "QUERY_LIMIT_EXCEEDED"
+        except ValueError:
+            return False
+
+    @staticmethod
+    def _retry_after(response: httpx.Response) -> Optional[float]:
+        try:
+            return float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return None
+
+    async def _post(self, method: str, json_data: dict = None, priority: Optional[int] = None) -> Dict[str, Any]:
         url = f"{self.base_url}/{method}.json"
+        limiter = get_rate_limiter(self.domain) if settings.BITRIX_RATE_LIMIT_ENABLED else None
+        if priority is None:
+            priority = method_priority(method, json_data)
+        started = time.perf_counter()
+        deadline = time.monotonic() + settings.BITRIX_RATE_LIMIT_QUEUE_TIMEOUT
+        token_refreshed = False
+        limit_retries = 0
         try:
-            resp = await self.client.post(url, params=self.auth_params, json=json_data)
-            resp.raise_for_status()
-            return resp.json()
+            while True:
+                if limiter is not None:
+                    await limiter.acquire(priority, deadline)
+                resp = await self.client.post(url, params=self.auth_params, json=json_data)
+
+                if self.token_refresher is not None and not token_refreshed and self._is_expired_token(resp):
+                    # Токен истек: обновляем (одним запросом на портал) и повторяем вызов один раз
+                    logger.info("Access token expired on %s, refreshing [%s]", self.domain, method)
+                    self.auth_params = {"auth": await self.token_refresher()}
+                    token_refreshed = True
+                    continue
+
+                if limiter is not None:
+                    if self._is_query_limit(resp):
+                        if limit_retries < settings.BITRIX_RATE_LIMIT_MAX_RETRIES:
+                            # Портал просит притормозить: ждем в очереди лимитера и повторяем
+                            limit_retries += 1
+                            delay = limiter.penalize(self._retry_after(resp))
+                            logger.warning("Query limit exceeded on %s [%s], retry %s in %.1fs",
+                                           self.domain, method, limit_retries, delay)
+                            continue
+                    else:
+                        limiter.record_success()
+
+                resp.raise_for_status()
+                return resp.json()
         except httpx.HTTPStatusError as e:
-            logger.error(f"Bitrix API Error [{method}]: {e.response.text}")
+            BITRIX_REST_ERRORS.inc(method, self.metrics_portal, f"http_{e.response.status_code}")
+            # Ошибка портала бывает с мегабайтной HTML-страницей: декодируем только начало тела
+            logger.error("Bitrix API Error [%s] on %s: %s", method, self.domain,
+                         e.response.content[:500].decode("utf-8", "replace"))
             raise
         except httpx.RequestError as e:
-            logger.error(f"Network Error [{method}]: {e}")
+            BITRIX_REST_ERRORS.inc(method, self.metrics_portal, "network")
+            logger.error("Network Error [%s] on %s: %s", method, self.domain, e)
             raise
+        except RateLimitExceeded:
+            BITRIX_REST_ERRORS.inc(method, self.metrics_portal, "rate_limited")
+            raise
+        finally:
+            BITRIX_REST_DURATION.observe(time.perf_counter() - started, method, self.metrics_portal)
+
+    async def install_robot(self, payload: Dict[str, Any], update: bool = False) -> str:
+        """
+        Регистрирует робота без удаления: bizproc.robot.add для нового робота,
+        bizproc.robot.update для уже зарегистрированного (робот не пропадает из живых процессов).
+        Если предположение о наличии робота неверно, переключается на другой метод.
 
-    async def install_robot(self, config: RobotConfig):
+        Returns:
+            str: "added" или "updated".
+        """
+        if update:
+            try:
+                await self._post("bizproc.robot.update", self._update_params(payload))
+                return "updated"
+            except httpx.HTTPStatusError as e:
+                if bitrix_error_code(e) != "ERROR_ACTIVITY_NOT_FOUND":
+                    raise
         try:
-            await self._post("bizproc.robot.delete", {"CODE": config.code})
-        except Exception:
-            pass
+            await self._post("bizproc.robot.add", payload)
+            return "added"
+        except httpx.HTTPStatusError as e:
+            if bitrix_error_code(e) != "ERROR_ACTIVITY_ALREADY_INSTALLED":
+                raise
+        await self._post("bizproc.robot.update", self._update_params(payload))
+        return "updated"
 
-        payload = {
-            "CODE": config.code,
-            "HANDLER": config.handler_url,
-            "AUTH_USER_ID": 1,
-            "USE_SUBSCRIPTION": "Y",
-            "NAME": config.name,
-            "PROPERTIES": {k: v.model_dump(exclude_none=True) for k, v in config.properties.items()},
-            "RETURN_PROPERTIES": {k: v.model_dump(exclude_none=True) for k, v in config.return_properties.items()},
-            "FILTER": {"INCLUDE": [["crm", "CCrmDocumentDeal"]]}
-        }
-        return await self._post("bizproc.robot.add", payload)
+    @staticmethod
+    def _update_params(payload: Dict[str, Any]) -> Dict[str, Any]:
+        return {"CODE": payload["CODE"], "FIELDS": {k: v for k, v in payload.items() if k != "CODE"}}
+
+    async def call_chain(self, commands: List[Command], batch: Optional[bool] = None) -> Dict[str, Any]:
+        """
+        Выполняет цепочку команд [(имя, метод, параметры), ...].
+        Параметры могут ссылаться на результат предыдущей команды строкой "$result[имя]".
+        С batch=True (по умолчанию — BITRIX_BATCH_ENABLED) цепочка уходит в общий batch портала,
+        иначе команды выполняются последовательно отдельными запросами.
+        В обоих режимах ошибка команды прерывает цепочку: следующие команды не отправляются.
+        """
+        if settings.BITRIX_BATCH_ENABLED if batch is None else batch:
+            return await get_batcher(self.domain).submit(self, commands)
 
-    async def add_contact(self, fields: dict) -> Optional[int]:
-        result = await self._post("crm.contact.add", {"fields": fields})
-        return result.get("result")
+        results: Dict[str, Any] = {}
+        for name, method, params in commands:
+            response = await self._post(method, resolve_references(params, results))
+            results[name] = response.get("result")
+        return results
 
-    async def send_robot_result(self, event_token: str, return_values: dict):
+    async def call_batch(self, commands: List[Command]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Независимые команды одним запросом batch.json (halt=0).
+        В отличие от call_chain, ошибка одной команды не отменяет результаты остальных.
+
+        Returns:
+            tuple: (имя команды -> result, имя команды -> ошибка).
+        """
+        cmd = {name: encode_command(method, params or {}) for name, method, params in commands}
+        response = await self._post("batch", {"halt": 0, "cmd": cmd})
+        return parse_batch_response(response)
+
+    async def call(self, method: str, params: dict = None, batch: Optional[bool] = None) -> Any:
+        results = await self.call_chain([("call", method, params or {})], batch=batch)
+        return results["call"]
+
+    async def add_contact(self, fields: dict, batch: Optional[bool] = None) -> Optional[int]:
+        return await self.call("crm.contact.add", {"fields": fields}, batch=batch)
+
+    async def send_robot_result(self, event_token: str, return_values: dict, batch: Optional[bool] = None):
         payload = {
             "event_token": event_token,
             "return_values": return_values
         }
-        await self._post("bizproc.event.send", payload)
\ No newline at end of file
+        await self.call("bizproc.event.send", payload, batch=batch)
+
+    async def find_contact_by_comm(self, phones: List[str], emails: List[str],
+                                   batch: Optional[bool] = None) -> Optional[int]:
+        """
+        Ищет существующий контакт по телефону/email (crm.duplicate.findbycomm).
+        Телефон и email проверяются одним запросом: в batch-режиме — в общем batch портала,
+        без него — собственным batch.json. Ошибка любой из проверок выбрасывается (BitrixBatchError).
+        """
+        commands = []
+        if phones:
+            commands.append(("phone", "crm.duplicate.findbycomm",
+                             {"entity_type": "CONTACT", "type": "PHONE", "values": phones}))
+        if emails:
+            commands.append(("email", "crm.duplicate.findbycomm",
+                             {"entity_type": "CONTACT", "type": "EMAIL", "values": emails}))
+        if not commands:
+            return None
+
+        if len(commands) > 1 and not (settings.BITRIX_BATCH_ENABLED if batch is None else batch):
+            results, errors = await self.call_batch(commands)
+            if errors:
+                raise BitrixBatchError("crm.duplicate.findbycomm", next(iter(errors.values())))
+        else:
+            results = await self.call_chain(commands, batch=batch)
+        for name, _, _ in commands:
+            # Если совпадений нет, Битрикс возвращает пустой список вместо объекта
+            found = results.get(name) or {}
+            ids = found.get("CONTACT") if isinstance(found, dict) else None
+            if ids:
+                return min(int(i) for i in ids)
+        return None
+
+    async def add_contact_and_send_result(self, fields: dict, event_token: str, return_values: dict,
+                                          batch: Optional[bool] = None) -> Optional[int]:
+        """
+        Создает контакт и сразу отправляет результат робота.
+        ID контакта подставляется в created_contact_id ссылкой $result[contact]; если контакт
+        не создан, результат робота не отправляется. В batch-режиме каждая команда уходит
+        в общий batch портала вместе с командами других вызовов.
+        """
+        results = await self.call_chain([
+            ("contact", "crm.contact.add", {"fields": fields}),
+            ("event", "bizproc.event.send", {
+                "event_token": event_token,
+                "return_values": {**return_values, "created_contact_id": "$result[contact]"}
+            })
+        ], batch=batch)
+        return results["contact"]
\ No newline at end of file
@@ -0,0 +1,103 @@
+import logging
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+from repositories.sqlite_db import SQLiteDatabase
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS contact_index (
+    domain TEXT NOT NULL,
+    key TEXT NOT NULL,
+    contact_id INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (domain, key)
+);
+"""
+
+_NON_DIGITS = re.compile(r"\D")
+
+
+def normalize_phone(phone: Optional[str], country_code: str = None) -> Optional[str]:
+    """
+    Приводит телефон к E.164 (+79991234567).
+    Российские номера вида 8XXXXXXXXXX и номера из 10 цифр дополняются кодом страны.
+    """
+    if not phone:
+        return None
+    country_code = settings.CONTACT_DEDUP_COUNTRY_CODE if country_code is None else country_code
+    digits = _NON_DIGITS.sub("", phone)
+    if not phone.strip().startswith("+"):
+        if len(digits) == 11 and digits.startswith("8") and country_code == "7":
+            digits = "7" + digits[1:]
+        elif len(digits) == 10:
+            digits = country_code + digits
+    if not 10 <= len(digits) <= 15:
+        return None
+    return "+" + digits
+
+
+def normalize_email(email: Optional[str]) -> Optional[str]:
+    if not email:
+        return None
+    email = email.strip().lower()
+    return email if "@" in email else None
+
+
+def contact_keys(phone: Optional[str], email: Optional[str]) -> List[str]:
+    keys = []
+    phone = normalize_phone(phone)
+    if phone:
+        keys.append(f"phone:{phone}")
+    email = normalize_email(email)
+    if email:
+        keys.append(f"email:{email}")
+    return keys
+
+
+class ContactIndex:
+    """
+    Локальный индекс контактов порталов: нормализованный телефон/email -> ID контакта.
+    Записи живут в памяти ttl секунд и сохраняются в SQLite, чтобы пережить перезапуск.
+    """
+    def __init__(self, db_path: str, ttl: float = None):
+        self.db = SQLiteDatabase(db_path)
+        self.ttl = settings.CONTACT_DEDUP_TTL if ttl is None else ttl
+        self._entries: Dict[Tuple[str, str], Tuple[int, float]] = {}
+
+    async def init(self):
+        await self.db.executescript(SCHEMA)
+        cutoff = time.time() - self.ttl
+        await self.db.execute("DELETE FROM contact_index WHERE updated_at < ?", (cutoff,))
+        rows = await self.db.execute("SELECT domain, key, contact_id, updated_at FROM contact_index")
+        for row in rows:
+            self._entries[(row["domain"], row["key"])] = (row["contact_id"], row["updated_at"])
+        logger.info("Loaded %s contact index entries", len(rows))
+
+    def lookup(self, domain: str, keys: List[str]) -> Optional[int]:
+        now = time.time()
+        for key in keys:
+            entry = self._entries.get((domain, key))
+            if entry is None:
+                continue
+            if now - entry[1] > self.ttl:
+                del self._entries[(domain, key)]
+                continue
+            return entry[0]
+        return None
+
+    async def remember(self, domain: str, keys: List[str], contact_id: int):
+        if not keys or not contact_id:
+            return
+        now = time.time()
+        for key in keys:
+            self._entries[(domain, key)] = (contact_id, now)
+        await self.db.run(lambda conn: conn.executemany(
+            "INSERT OR REPLACE INTO contact_index (domain, key, contact_id, updated_at) VALUES (?, ?, ?, ?)",
+            [(domain, key, contact_id, now) for key in keys]
+        ))
+
+    async def close(self):
+        await self.db.close()
@@ -0,0 +1,370 @@
+import asyncio
+import csv
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+from pydantic import ValidationError
+from schemas import ContactCreateDTO
+from config import settings
+from .bitrix_client import BitrixClient
+from .processing import RobotService, build_crm_fields
+
+logger = logging.getLogger(__name__)
+
+# Как часто писать в лог прогресс импорта (секунды)
+PROGRESS_INTERVAL = 5.0
+
+# Колонки входного файла -> поля ContactCreateDTO (имена полей DTO и полей CRM/робота)
+COLUMN_ALIASES = {
+    "last_name": "last_name", "LAST_NAME": "last_name",
+    "first_name": "first_name", "NAME": "first_name",
+    "second_name": "second_name", "SECOND_NAME": "second_name",
+    "phone": "phone", "PHONE": "phone",
+    "email": "email", "EMAIL": "email",
+}
+
+# Строка входного файла: (номер строки данных, исходные поля)
+Row = Tuple[int, Dict[str, Any]]
+
+
+class ContactImportError(Exception):
+    """Импорт нельзя начать или продолжить."""
+
+
+def detect_format(path: str) -> str:
+    return "jsonl" if path.lower().endswith((".jsonl", ".ndjson", ".json")) else "csv"
+
+
+def iter_rows(f, fmt: str) -> Iterator[Row]:
+    """Построчно читает CSV (с заголовком) или JSONL; файл целиком в память не загружается."""
+    if fmt == "csv":
+        for number, record in enumerate(csv.DictReader(f), start=1):
+            yield number, record
+        return
+    for number, line in enumerate(f, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            record = {"__error__": f"Invalid JSON: {e}"}
+        yield number, record if isinstance(record, dict) else {"__error__": "Row is not a JSON object"}
+
+
+def to_contact(record: Dict[str, Any]) -> ContactCreateDTO:
+    """Приводит строку файла к ContactCreateDTO; фамилия обязательна, как и в вызове робота."""
+    if "__error__" in record:
+        raise ValueError(record["__error__"])
+    fields = {"first_name": "", "second_name": "", "phone": "", "email": ""}
+    for column, value in record.items():
+        field = COLUMN_ALIASES.get(column.strip() if isinstance(column, str) else column)
+        if field and value is not None:
+            fields[field] = str(value).strip()
+    contact = ContactCreateDTO(**fields)
+    if not contact.last_name:
+        raise ValueError("LAST_NAME required")
+    return contact
+
+
+def read_checkpoint(path: str) -> Optional[dict]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class ContactImporter:
+    """
+    Потоковый импорт контактов в портал.
+    - Строки читаются и валидируются порциями по chunk_size; каждая порция — один
+      batch.json с командами crm.contact.add. Одновременно в работе не больше
+      concurrency порций, поэтому память не зависит от размера файла.
+    - slots ограничивает число batch-запросов к порталу; импорты одного портала,
+      запущенные через API, делят общий семафор (portal_import_slots).
+    - Результат каждой строки дописывается в results_path (JSONL: row, status, contact_id / error).
+    - checkpoint_path хранит номер строки, до которой включительно все обработано.
+      Повторный запуск продолжает с этого места; строки после него, уже попавшие
+      в файл результатов, не отправляются повторно.
+    """
+    def __init__(self, service: RobotService, domain: str, source: str, fmt: Optional[str] = None,
+                 results_path: Optional[str] = None, checkpoint_path: Optional[str] = None,
+                 chunk_size: int = None, concurrency: int = None,
+                 slots: Optional[asyncio.Semaphore] = None):
+        self.service = service
+        self.domain = domain
+        self.source = source
+        self.fmt = fmt or detect_format(source)
+        paths = source_paths(source)
+        self.results_path = results_path or paths["results"]
+        self.checkpoint_path = checkpoint_path or paths["checkpoint"]
+        chunk_size = settings.IMPORT_CHUNK_SIZE if chunk_size is None else chunk_size
+        # В один batch помещается не больше 50 команд
+        self.chunk_size = max(1, min(chunk_size, 50))
+        self.concurrency = max(1, settings.IMPORT_CONCURRENCY if concurrency is None else concurrency)
+        self._slots = slots or asyncio.Semaphore(self.concurrency)
+
+        self.counts = {"created": 0, "invalid": 0, "error": 0}
+        self.rows_done = 0
+        self.status = "pending"
+        self.error: Optional[str] = None
+        self._processed_now = 0
+        self._started = 0.0
+        self._logged_at = 0.0
+        self._client: Optional[BitrixClient] = None
+        self._done_ahead: Set[int] = set()
+        self._last_row = 0
+        self._failure: Optional[BaseException] = None
+        self._chunk_last_row: Dict[int, int] = {}
+        self._completed_chunks: Set[int] = set()
+        self._next_chunk = 0
+        self._write_lock = asyncio.Lock()
+
+    def _resume(self) -> int:
+        """Восстанавливает позицию и счетчики по checkpoint и файлу результатов."""
+        checkpoint = read_checkpoint(self.checkpoint_path)
+        if checkpoint is None:
+            if os.path.exists(self.results_path):
+                os.remove(self.results_path)
+            return 0
+        if checkpoint.get("source") != os.path.abspath(self.source) or checkpoint.get("domain") != self.domain:
+            raise ContactImportError(f"{self.checkpoint_path} belongs to another import; remove it to start over")
+
+        rows_done = int(checkpoint.get("rows_done", 0))
+        if os.path.exists(self.results_path):
+            with open(self.results_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        # Строка, недописанная при аварийной остановке
+                        continue
+                    self.counts[result["status"]] = self.counts.get(result["status"], 0) + 1
+                    if result["row"] > rows_done:
+                        self._done_ahead.add(result["row"])
+        return rows_done
+
+    def _pending_rows(self, f, skip_until: int) -> Iterator[Row]:
+        for row in iter_rows(f, self.fmt):
+            self._last_row = row[0]
+            if row[0] > skip_until and row[0] not in self._done_ahead:
+                yield row
+
+    def snapshot(self) -> dict:
+        elapsed = time.monotonic() - self._started if self._started else 0.0
+        return {
+            "source": os.path.abspath(self.source),
+            "domain": self.domain,
+            "status": self.status,
+            "rows_done": self.rows_done,
+            "counts": dict(self.counts),
+            "rows_per_second": round(self._processed_now / elapsed, 2) if elapsed else 0.0,
+            "results": self.results_path,
+            "error": self.error,
+            "updated_at": int(time.time()),
+        }
+
+    def _write_checkpoint(self):
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _append_results(self, results: List[dict]):
+        with open(self.results_path, "a", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def run(self) -> dict:
+        self.status = "running"
+        self._started = self._logged_at = time.monotonic()
+        self.rows_done = skip_until = await asyncio.to_thread(self._resume)
+        if skip_until:
+            logger.info("Resuming import of %s into %s after row %s", self.source, self.domain, skip_until)
+        await asyncio.to_thread(self._write_checkpoint)
+
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        try:
+            self._client = await self.service.portal_client(domain=self.domain)
+            with open(self.source, encoding="utf-8-sig", newline="") as f:
+                rows = self._pending_rows(f, skip_until)
+                for seq in itertools.count():
+                    # Ошибка запроса к порталу останавливает чтение файла
+                    if self._failure is not None:
+                        break
+                    chunk = await asyncio.to_thread(list, itertools.islice(rows, self.chunk_size))
+                    if not chunk:
+                        break
+                    self._chunk_last_row[seq] = chunk[-1][0]
+                    await queue.put((seq, chunk))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+            if self._failure is not None:
+                raise self._failure
+            # Хвост файла мог быть целиком обработан в прошлый раз
+            self.rows_done = max(self.rows_done, self._last_row)
+            self.status = "completed"
+        except asyncio.CancelledError:
+            self.status = "interrupted"
+            raise
+        except Exception as e:
+            self.status, self.error = "failed", str(e)
+            logger.error("Import of %s into %s failed: %s", self.source, self.domain, e)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await asyncio.to_thread(self._write_checkpoint)
+
+        snapshot = self.snapshot()
+        logger.info("Import of %s into %s %s: %s, %s rows/s",
+                    self.source, self.domain, self.status, snapshot["counts"], snapshot["rows_per_second"])
+        return snapshot
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            if self._failure is not None:
+                # Разбираем очередь, чтобы чтение файла не зависло на put()
+                continue
+            seq, chunk = item
+            try:
+                async with self._slots:
+                    results = await self._import_chunk(chunk)
+            except Exception as e:
+                self._failure = e
+                continue
+            await self._chunk_done(seq, results)
+
+    async def _import_chunk(self, chunk: List[Row]) -> List[dict]:
+        results: Dict[int, dict] = {}
+        commands = []
+        for number, record in chunk:
+            try:
+                contact = to_contact(record)
+            except (ValidationError, ValueError) as e:
+                results[number] = {"row": number, "status": "invalid", "error": str(e)}
+                continue
+            commands.append((f"r{number}", "crm.contact.add", {"fields": build_crm_fields(contact)}))
+
+        if commands:
+            # Ошибка всего запроса (сеть, лимиты после повторов) прерывает импорт:
+            # строки порции не попадут в checkpoint и будут отправлены при следующем запуске
+            created, errors = await self._client.call_batch(commands)
+            for name, _, _ in commands:
+                number = int(name[1:])
+                if name in errors or not created.get(name):
+                    error = errors.get(name) or "Empty result"
+                    results[number] = {"row": number, "status": "error", "error": error}
+                else:
+                    results[number] = {"row": number, "status": "created", "contact_id": created[name]}
+        return [results[number] for number, _ in chunk]
+
+    async def _chunk_done(self, seq: int, results: List[dict]):
+        async with self._write_lock:
+            for result in results:
+                self.counts[result["status"]] += 1
+            self._processed_now += len(results)
+
+            # rows_done двигается только по непрерывному префиксу завершенных порций
+            self._completed_chunks.add(seq)
+            while self._next_chunk in self._completed_chunks:
+                self._completed_chunks.discard(self._next_chunk)
+                self.rows_done = self._chunk_last_row.pop(self._next_chunk)
+                self._next_chunk += 1
+
+            await asyncio.to_thread(self._append_results, results)
+            await asyncio.to_thread(self._write_checkpoint)
+
+            now = time.monotonic()
+            if now - self._logged_at >= PROGRESS_INTERVAL:
+                self._logged_at = now
+                snapshot = self.snapshot()
+                logger.info("Import into %s: %s rows done, %s, %s rows/s",
+                            self.domain, self.rows_done, snapshot["counts"], snapshot["rows_per_second"])
+
+
+# Импорты, запущенные через API (ключ — id импорта)
+_imports: Dict[str, asyncio.Task] = {}
+
+# Batch-запросы импорта по доменам порталов: сколько бы импортов ни шло в один портал,
+# вместе они держат в работе не больше IMPORT_CONCURRENCY запросов (в пределах процесса)
+_portal_slots: Dict[str, asyncio.Semaphore] = {}
+
+
+def portal_import_slots(domain: str) -> asyncio.Semaphore:
+    key = domain.lower()
+    slots = _portal_slots.get(key)
+    if slots is None:
+        slots = _portal_slots[key] = asyncio.Semaphore(max(1, settings.IMPORT_CONCURRENCY))
+    return slots
+
+
+def import_paths(import_id: str, fmt: str) -> Dict[str, str]:
+    base = os.path.join(settings.IMPORT_DIR, import_id)
+    return {"source": f"{base}.{fmt}", "results": f"{base}.results.jsonl", "checkpoint": f"{base}.checkpoint.json"}
+
+
+def is_import_id(import_id: str) -> bool:
+    # id — это uuid4().hex; все остальное не должно превращаться в путь к файлу
+    return len(import_id) == 32 and all(c in "0123456789abcdef" for c in import_id)
+
+
+def source_paths(source: str) -> Dict[str, str]:
+    """
+    Файлы результатов и checkpoint для входного файла.
+    Для файла, загруженного через API (IMPORT_DIR/<id>.<fmt>), — те же, что у API-импорта,
+    поэтому прерванный API-импорт можно продолжить командой import-contacts.
+    """
+    directory, name = os.path.split(source)
+    import_id, ext = os.path.splitext(name)
+    if ext in (".csv", ".jsonl") and is_import_id(import_id) \
+            and os.path.abspath(directory) == os.path.abspath(settings.IMPORT_DIR):
+        return import_paths(import_id, ext[1:])
+    return {"source": source, "results": f"{source}.results.jsonl", "checkpoint": f"{source}.checkpoint.json"}
+
+
+def new_import_id() -> str:
+    return uuid.uuid4().hex
+
+
+def start_import(service: RobotService, domain: str, import_id: str, fmt: str) -> ContactImporter:
+    """Запускает импорт загруженного файла в фоне."""
+    paths = import_paths(import_id, fmt)
+    importer = ContactImporter(service, domain, paths["source"], fmt=fmt,
+                               results_path=paths["results"], checkpoint_path=paths["checkpoint"],
+                               slots=portal_import_slots(domain))
+    task = asyncio.create_task(importer.run())
+    _imports[import_id] = task
+    task.add_done_callback(lambda _: _imports.pop(import_id, None))
+    return importer
+
+
+def import_status(import_id: str) -> Optional[dict]:
+    """Состояние импорта по checkpoint-файлу (доступно из любого воркера)."""
+    if not is_import_id(import_id):
+        return None
+    for fmt in ("csv", "jsonl"):
+        checkpoint = read_checkpoint(import_paths(import_id, fmt)["checkpoint"])
+        if checkpoint is not None:
+            return checkpoint
+    return None
+
+
+async def cancel_imports():
+    """Останавливает фоновые импорты; checkpoint позволит продолжить их позже."""
+    tasks = list(_imports.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
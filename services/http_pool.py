@@ -0,0 +1,92 @@
+import httpx
+import logging
+from typing import Any, Dict, Optional
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClientPool:
+    """
+    Общий (на всё приложение) пул HTTP-соединений к порталам Bitrix24.
+    Клиент создается один раз при старте приложения (lifespan) и переиспользуется
+    всеми запросами, поэтому TCP+TLS рукопожатие с порталом выполняется один раз
+    и дальше соединение живет в keep-alive.
+    """
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("HTTP client pool is not started")
+        return self._client
+
+    async def start(self) -> httpx.AsyncClient:
+        if self._client is not None:
+            return self._client
+
+        http2 = settings.HTTP2_ENABLED
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("HTTP/2 requested but 'h2' package is not installed, falling back to HTTP/1.1")
+                http2 = False
+
+        limits = httpx.Limits(
+            max_connections=settings.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY
+        )
+        timeout = httpx.Timeout(
+            settings.HTTP_READ_TIMEOUT,
+            connect=settings.HTTP_CONNECT_TIMEOUT,
+            pool=settings.HTTP_CONNECT_TIMEOUT
+        )
+        self._client = httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2)
+        logger.info("HTTP client pool started (http2=%s, max_connections=%s)",
+                    http2, settings.HTTP_MAX_CONNECTIONS)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logger.info("HTTP client pool closed")
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Статистика пула соединений: сколько соединений открыто к каждому порталу,
+        сколько из них простаивает в keep-alive и сколько запросов ждут свободного соединения.
+        """
+        result: Dict[str, Any] = {
+            "started": self._client is not None,
+            "connections": 0,
+            "idle": 0,
+            "active": 0,
+            "queued_requests": 0,
+            "origins": {}
+        }
+        if self._client is None:
+            return result
+
+        # httpx не дает публичного API к пулу, поэтому читаем состояние httpcore аккуратно
+        pool = getattr(self._client._transport, "_pool", None)
+        if pool is None:
+            return result
+
+        for conn in getattr(pool, "connections", []):
+            origin = getattr(conn, "_origin", None)
+            key = str(origin) if origin is not None else "unknown"
+            entry = result["origins"].setdefault(key, {"connections": 0, "idle": 0, "active": 0})
+            idle = conn.is_idle()
+            entry["connections"] += 1
+            entry["idle" if idle else "active"] += 1
+            result["connections"] += 1
+            result["idle" if idle else "active"] += 1
+
+        result["queued_requests"] = sum(
+            1 for r in getattr(pool, "_requests", []) if getattr(r, "is_queued", lambda: False)()
+        )
+        return result
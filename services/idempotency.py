@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from repositories.sqlite_db import SQLiteDatabase
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed_events (
+    event_token TEXT PRIMARY KEY,
+    outcome TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    pending INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_processed_events_created_at ON processed_events(created_at);
+"""
+
+# Колонки, добавленные после первой версии схемы (для баз, созданных раньше)
+MIGRATIONS = {
+    "pending": "ALTER TABLE processed_events ADD COLUMN pending INTEGER NOT NULL DEFAULT 0",
+}
+
+# Результат попытки занять event_token в базе
+CLAIMED, DONE, BUSY = "claimed", "done", "busy"
+
+
+class IdempotencyGuard:
+    """
+    Защита от повторной обработки одного и того же вызова робота (ключ — event_token).
+    Битрикс повторяет вызов, если ответ задержался или потерялся; без защиты каждый
+    повтор создает еще один контакт и еще раз отправляет bizproc.event.send.
+    - Недавние результаты хранятся в LRU в памяти и в SQLite с TTL.
+    - Повтор, пришедший во время выполнения оригинала, ждет его результат: в том же процессе —
+      общую задачу, в другом воркере — пока в базе не появится результат. Перед выполнением
+      event_token занимается в базе строкой pending; строка, не завершенная за pending_timeout
+      секунд (воркер упал), переходит к следующему повтору.
+    - Ошибки не кэшируются: следующий повтор выполнится заново.
+    - Записи старше TTL удаляются при старте и в фоне не чаще раза в purge_interval секунд.
+    """
+    def __init__(self, db_path: str, cache_size: int = None, ttl: float = None, purge_interval: float = None,
+                 pending_timeout: float = None, poll_interval: float = 0.05):
+        self.db = SQLiteDatabase(db_path)
+        self.cache_size = settings.IDEMPOTENCY_CACHE_SIZE if cache_size is None else cache_size
+        self.ttl = settings.IDEMPOTENCY_TTL if ttl is None else ttl
+        self.purge_interval = settings.IDEMPOTENCY_PURGE_INTERVAL if purge_interval is None else purge_interval
+        self.pending_timeout = settings.IDEMPOTENCY_PENDING_TIMEOUT if pending_timeout is None else pending_timeout
+        self.poll_interval = poll_interval
+        self._purged_at = 0.0
+        self._purge_task: Optional[asyncio.Task] = None
+        self._cache: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._counters = {"hits": 0, "store_hits": 0, "attached": 0, "waited": 0, "misses": 0}
+
+    async def init(self):
+        def _migrate(conn):
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(processed_events)")}
+            for column, sql in MIGRATIONS.items():
+                if column not in columns:
+                    conn.execute(sql)
+
+        await self.db.executescript(SCHEMA)
+        await self.db.run(_migrate)
+        await self.purge()
+
+    async def purge(self):
+        self._purged_at = time.monotonic()
+        rows = await self.db.execute(
+            "DELETE FROM processed_events WHERE created_at < ? RETURNING event_token",
+            (time.time() - self.ttl,)
+        )
+        if rows:
+            logger.info("Purged %s expired idempotency record(s)", len(rows))
+
+    def _maybe_purge(self):
+        # Удаление идет в потоке базы, но не задерживает ответ вызвавшему запросу
+        if time.monotonic() - self._purged_at < self.purge_interval:
+            return
+        if self._purge_task is None or self._purge_task.done():
+            self._purge_task = asyncio.create_task(self._purge_quietly())
+
+    async def _purge_quietly(self):
+        try:
+            await self.purge()
+        except Exception as e:
+            logger.error("Failed to purge idempotency records: %s", e)
+
+    def _cached(self, event_token: str) -> Optional[Tuple[float, Any]]:
+        entry = self._cache.get(event_token)
+        if entry is None:
+            return None
+        if time.time() - entry[0] > self.ttl:
+            del self._cache[event_token]
+            return None
+        self._cache.move_to_end(event_token)
+        return entry
+
+    def _remember(self, event_token: str, created_at: float, outcome: Any):
+        self._cache[event_token] = (created_at, outcome)
+        self._cache.move_to_end(event_token)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def run(self, event_token: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполняет fn() один раз для event_token; повторы получают сохраненный результат."""
+        entry = self._cached(event_token)
+        if entry is not None:
+            self._counters["hits"] += 1
+            return entry[1]
+
+        inflight = self._inflight.get(event_token)
+        if inflight is not None:
+            self._counters["attached"] += 1
+            return await asyncio.shield(inflight)
+
+        task = asyncio.ensure_future(self._execute(event_token, fn))
+        self._inflight[event_token] = task
+        task.add_done_callback(lambda _: self._inflight.pop(event_token, None))
+        return await asyncio.shield(task)
+
+    def _claim(self, conn, event_token: str) -> Tuple[str, Optional[sqlite3.Row]]:
+        """Занимает event_token строкой pending, если нет ни результата, ни живого выполнения."""
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT outcome, created_at, pending FROM processed_events WHERE event_token = ?", (event_token,)
+            ).fetchone()
+            if row is not None and not row["pending"] and row["created_at"] >= now - self.ttl:
+                state = DONE
+            elif row is not None and row["pending"] and row["created_at"] >= now - self.pending_timeout:
+                state = BUSY
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO processed_events (event_token, outcome, created_at, pending) "
+                    "VALUES (?, 'null', ?, 1)",
+                    (event_token, now)
+                )
+                state = CLAIMED
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return state, row
+
+    async def _execute(self, event_token: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        delay = self.poll_interval
+        waited = False
+        while True:
+            state, row = await self.db.run(self._claim, event_token)
+            if state == CLAIMED:
+                break
+            if state == DONE:
+                self._counters["waited" if waited else "store_hits"] += 1
+                outcome = json.loads(row["outcome"])
+                self._remember(event_token, row["created_at"], outcome)
+                return outcome
+            # Вызов с этим event_token выполняет другой воркер: ждем его результат
+            waited = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+        self._counters["misses"] += 1
+        try:
+            outcome = await fn()
+        except BaseException:
+            # Ошибки не кэшируются: освобождаем event_token для следующего повтора
+            await self._release(event_token)
+            raise
+
+        created_at = time.time()
+        self._remember(event_token, created_at, outcome)
+        try:
+            await self.db.execute(
+                "INSERT OR REPLACE INTO processed_events (event_token, outcome, created_at, pending) "
+                "VALUES (?, ?, ?, 0)",
+                (event_token, json.dumps(outcome, ensure_ascii=False, default=str), created_at)
+            )
+        except Exception as e:
+            # Результат уже получен; потеря записи грозит только повтором после рестарта
+            logger.error("Failed to persist idempotency record for %s: %s", event_token, e)
+        self._maybe_purge()
+        return outcome
+
+    async def _release(self, event_token: str):
+        try:
+            await self.db.execute(
+                "DELETE FROM processed_events WHERE event_token = ? AND pending = 1", (event_token,))
+        except Exception as e:
+            # Строку заберет следующий повтор после pending_timeout
+            logger.error("Failed to release idempotency claim for %s: %s", event_token, e)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._counters, "cached": len(self._cache), "inflight": len(self._inflight)}
+
+    async def close(self):
+        if self._purge_task is not None:
+            await asyncio.gather(self._purge_task, return_exceptions=True)
+        await self.db.close()
@@ -0,0 +1,262 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+from repositories.sqlite_db import SQLiteDatabase
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_token TEXT UNIQUE,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_run_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    last_error TEXT,
+    claimed_by INTEGER,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_status_next_run ON jobs(status, next_run_at);
+CREATE TABLE IF NOT EXISTS dead_jobs (
+    id INTEGER PRIMARY KEY,
+    event_token TEXT,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    failed_at REAL NOT NULL,
+    last_error TEXT
+);
+"""
+
+# Колонки, добавленные после первой версии схемы (для баз, созданных раньше)
+MIGRATIONS = {
+    "claimed_by": "ALTER TABLE jobs ADD COLUMN claimed_by INTEGER",
+    "claimed_at": "ALTER TABLE jobs ADD COLUMN claimed_at REAL",
+}
+
+JobHandler = Callable[[dict], Awaitable[Any]]
+
+
+class JobQueue:
+    """
+    Надежная очередь задач робота на диске (SQLite, WAL).
+    Задача остается в базе до успешного выполнения, поэтому переживает перезапуск процесса;
+    задачи, исчерпавшие попытки, переносятся в таблицу dead_jobs.
+    Взятая задача арендуется процессом (claimed_by / claimed_at): пока она выполняется,
+    аренду продлевает heartbeat(). Если аренда не продлевалась дольше lease_timeout
+    (процесс упал или завис), задачу забирает обратно requeue_expired().
+    """
+    def __init__(self, db_path: str, lease_timeout: float = None):
+        self.db = SQLiteDatabase(db_path)
+        self.lease_timeout = settings.JOB_LEASE_TIMEOUT if lease_timeout is None else lease_timeout
+        self._wakeup = asyncio.Event()
+
+    async def init(self):
+        def _migrate(conn):
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, sql in MIGRATIONS.items():
+                if column not in columns:
+                    conn.execute(sql)
+
+        await self.db.executescript(SCHEMA)
+        await self.db.run(_migrate)
+        # Задачи других воркеров (при serve --workers N) не трогаем, пока их аренда действует
+        await self.requeue_expired()
+
+    async def enqueue(self, event_token: str, payload: dict) -> bool:
+        """
+        Ставит задачу в очередь.
+        Returns:
+            bool: False, если задача с таким event_token уже есть в очереди.
+        """
+        now = time.time()
+        rows = await self.db.execute(
+            "INSERT OR IGNORE INTO jobs (event_token, payload, next_run_at, created_at) "
+            "VALUES (?, ?, ?, ?) RETURNING id",
+            (event_token, json.dumps(payload, ensure_ascii=False), now, now)
+        )
+        self._wakeup.set()
+        return bool(rows)
+
+    async def claim(self) -> Optional[Dict[str, Any]]:
+        """Забирает первую готовую к выполнению задачу (status -> running, аренда текущего процесса)."""
+        def _claim(conn):
+            now = time.time()
+            with conn:
+                row = conn.execute(
+                    "UPDATE jobs SET status = 'running', claimed_by = ?, claimed_at = ? WHERE id = ("
+                    "  SELECT id FROM jobs WHERE status = 'pending' AND next_run_at <= ? "
+                    "  ORDER BY next_run_at, id LIMIT 1"
+                    ") RETURNING id, event_token, payload, attempts",
+                    (os.getpid(), now, now)
+                ).fetchone()
+            return dict(row) if row else None
+
+        job = await self.db.run(_claim)
+        if job:
+            job["payload"] = json.loads(job["payload"])
+        return job
+
+    async def heartbeat(self, job_ids: Iterable[int]):
+        """Продлевает аренду задач, которые выполняет текущий процесс."""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        placeholders = ",".join("?" * len(job_ids))
+        await self.db.execute(
+            f"UPDATE jobs SET claimed_at = ? WHERE status = 'running' AND claimed_by = ? AND id IN ({placeholders})",
+            (time.time(), os.getpid(), *job_ids)
+        )
+
+    async def requeue_expired(self) -> int:
+        """Возвращает в очередь задачи с истекшей арендой."""
+        rows = await self.db.execute(
+            "UPDATE jobs SET status = 'pending', claimed_by = NULL, claimed_at = NULL "
+            "WHERE status = 'running' AND (claimed_at IS NULL OR claimed_at < ?) RETURNING id",
+            (time.time() - self.lease_timeout,)
+        )
+        if rows:
+            logger.info("Requeued %s job(s) with expired lease", len(rows))
+            self._wakeup.set()
+        return len(rows)
+
+    async def complete(self, job_id: int):
+        await self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    async def retry(self, job_id: int, delay: float, error: str):
+        await self.db.execute(
+            "UPDATE jobs SET status = 'pending', attempts = attempts + 1, next_run_at = ?, last_error = ?, "
+            "claimed_by = NULL, claimed_at = NULL WHERE id = ?",
+            (time.time() + delay, error, job_id)
+        )
+
+    async def dead_letter(self, job_id: int, error: str):
+        def _move(conn):
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO dead_jobs (id, event_token, payload, attempts, created_at, failed_at, last_error) "
+                    "SELECT id, event_token, payload, attempts + 1, created_at, ?, ? FROM jobs WHERE id = ?",
+                    (time.time(), error, job_id)
+                )
+                conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+        await self.db.run(_move)
+
+    async def wait(self, timeout: float):
+        """Ждет новую задачу, но не дольше timeout (отложенные повторы проверяются по таймеру)."""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def stats(self) -> Dict[str, Any]:
+        """Глубина очереди, возраст самой старой задачи и размер dead-letter таблицы."""
+        rows = await self.db.execute(
+            "SELECT "
+            "  (SELECT COUNT(*) FROM jobs WHERE status = 'pending') AS pending, "
+            "  (SELECT COUNT(*) FROM jobs WHERE status = 'running') AS running, "
+            "  (SELECT MIN(created_at) FROM jobs) AS oldest_created_at, "
+            "  (SELECT COUNT(*) FROM dead_jobs) AS dead"
+        )
+        row = dict(rows[0])
+        oldest = row.pop("oldest_created_at")
+        row["depth"] = row["pending"] + row["running"]
+        row["oldest_age_seconds"] = round(time.time() - oldest, 3) if oldest else 0.0
+        return row
+
+    async def close(self):
+        await self.db.close()
+
+
+class JobWorkerPool:
+    """
+    Пул asyncio-воркеров, разбирающих очередь.
+    Неудачная задача повторяется с экспоненциальной задержкой (с джиттером),
+    после max_attempts попыток уходит в dead-letter таблицу.
+    Отдельная задача продлевает аренду выполняемых задач и подбирает задачи упавших процессов.
+    """
+    def __init__(self, queue: JobQueue, handler: JobHandler, workers: int = None, max_attempts: int = None,
+                 base_delay: float = None, max_delay: float = None, poll_interval: float = 1.0):
+        self.queue = queue
+        self.handler = handler
+        self.workers = settings.JOB_WORKERS if workers is None else workers
+        self.max_attempts = settings.JOB_MAX_ATTEMPTS if max_attempts is None else max_attempts
+        self.base_delay = settings.JOB_RETRY_BASE_DELAY if base_delay is None else base_delay
+        self.max_delay = settings.JOB_RETRY_MAX_DELAY if max_delay is None else max_delay
+        self.poll_interval = poll_interval
+        self._tasks: List[asyncio.Task] = []
+        self._running: Set[int] = set()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._heartbeat()))
+        logger.info("Started %s job worker(s)", self.workers)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.base_delay * (2 ** attempts), self.max_delay)
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _worker(self, index: int):
+        while True:
+            try:
+                job = await self.queue.claim()
+                if job is None:
+                    await self.queue.wait(self.poll_interval)
+                    continue
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Ошибка самой очереди (например, база занята) — не роняем воркер
+                logger.error("Job worker %s error: %s", index, e, exc_info=True)
+                await asyncio.sleep(self.poll_interval)
+
+    async def _heartbeat(self):
+        # Продлеваем аренду с запасом: несколько пропущенных тактов не приводят к повторному запуску
+        interval = self.queue.lease_timeout / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.queue.heartbeat(self._running)
+                await self.queue.requeue_expired()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Job lease heartbeat error: %s", e, exc_info=True)
+
+    async def _run(self, job: Dict[str, Any]):
+        self._running.add(job["id"])
+        try:
+            await self._execute(job)
+        finally:
+            self._running.discard(job["id"])
+
+    async def _execute(self, job: Dict[str, Any]):
+        try:
+            await self.handler(job["payload"])
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            attempts = job["attempts"] + 1
+            if attempts >= self.max_attempts:
+                logger.error("Job %s moved to dead letters after %s attempts: %s", job["id"], attempts, error)
+                await self.queue.dead_letter(job["id"], error)
+            else:
+                delay = self.backoff(job["attempts"])
+                logger.warning("Job %s failed (attempt %s), retry in %.1fs: %s", job["id"], attempts, delay, error)
+                await self.queue.retry(job["id"], delay, error)
+            return
+        await self.queue.complete(job["id"])
@@ -1,81 +1,176 @@
+import asyncio
 import logging
 import httpx
-from .bitrix_client import BitrixClient
+from typing import Dict, Optional
+from .bitrix_client import BitrixClient, build_robot_payload, payload_fingerprint
+from .token_manager import TokenManager
+from .contact_dedup import ContactIndex, contact_keys, normalize_email, normalize_phone
 from repositories.token_store import ITokenRepository
 from schemas import ContactCreateDTO
 from constants import DEFAULT_ROBOT_CONFIG
 from config import settings
+from metrics import ROBOT_IN_FLIGHT
 
 logger = logging.getLogger(__name__)
 
+# Регистрация робота сериализуется один раз при старте; хэш хранится в токенах портала
+ROBOT_PAYLOAD = build_robot_payload(
+    DEFAULT_ROBOT_CONFIG.model_copy(update={"handler_url": f"{settings.HOST_URL}/api/bitrix24"})
+)
+ROBOT_PAYLOAD_HASH = payload_fingerprint(ROBOT_PAYLOAD)
+
+
+def build_crm_fields(data: ContactCreateDTO) -> dict:
+    """Поля crm.contact.add из данных контакта."""
+    crm_fields = {
+        "NAME": data.first_name,
+        "LAST_NAME": data.last_name,
+        "SECOND_NAME": data.second_name,
+        "TYPE_ID": "CLIENT"
+    }
+    if data.phone:
+        crm_fields["PHONE"] = [{"VALUE": data.phone, "VALUE_TYPE": "WORK"}]
+    if data.email:
+        crm_fields["EMAIL"] = [{"VALUE": data.email, "VALUE_TYPE": "WORK"}]
+    return crm_fields
+
 
 class RobotService:
     """
     Сервис бизнес-логики.
     Оркестрирует работу между хранилищем токенов, HTTP-клиентом и данными.
     """
-    def __init__(self, repo: ITokenRepository, http_client: httpx.AsyncClient):
+    def __init__(self, repo: ITokenRepository, http_client: httpx.AsyncClient,
+                 contact_index: Optional[ContactIndex] = None):
         self.repo = repo
         self.http_client = http_client
+        self.token_manager = TokenManager(repo, http_client)
+        # Если индекс передан, робот не создает дубли существующих контактов
+        self.contact_index = contact_index
 
-    async def install_robot(self, domain: str, access_token: str):
+    def _client_for(self, tokens: dict) -> BitrixClient:
+        """
+        Клиент для портала из tokens. При ответе expired_token клиент сам обновит
+        токен через TokenManager и повторит вызов.
+        """
+        async def refresh() -> str:
+            fresh = await self.token_manager.refresh(tokens)
+            tokens.update(fresh)
+            return fresh["access_token"]
+
+        return BitrixClient(self.http_client, tokens["domain"], tokens["access_token"], token_refresher=refresh)
+
+    async def portal_client(self, domain: Optional[str] = None, member_id: Optional[str] = None) -> BitrixClient:
+        """Клиент портала с актуальными (при необходимости обновленными) токенами."""
+        tokens = await self.token_manager.get_tokens(domain=domain, member_id=member_id)
+        if not tokens or "domain" not in tokens:
+            raise ValueError("Tokens missing or corrupted")
+        return self._client_for(tokens)
+
+    async def install_robot(self, domain: str, access_token: str = None,
+                            fresh_install: bool = False, force: bool = False) -> str:
         """
                 Сценарий установки робота на портал
-        1. Создает клиента с переданными кредами.
-        2. Формирует конфигурацию робота (проставляя актуальный URL обработчика).
-        3. Отправляет запрос на регистрацию.
+        1. Сравнивает хэш заранее собранной регистрации с сохраненным для портала.
+        2. Если конфигурация не менялась — ничего не отправляет.
+        3. Иначе регистрирует (add) или обновляет (update) робота и запоминает хэш.
+
+        Args:
+            fresh_install (bool): Приложение только что установлено — прежней регистрации нет.
+            force (bool): Перерегистрировать даже при совпадении хэша.
+
+        Returns:
+            str: "skipped", "added" или "updated".
         """
-        client = BitrixClient(self.http_client, domain, access_token)
+        tokens = await self.repo.load(domain=domain) or {}
+        if access_token:
+            tokens.update({"domain": domain, "access_token": access_token})
+        if not tokens.get("access_token"):
+            raise ValueError(f"No tokens for {domain}")
 
-        config = DEFAULT_ROBOT_CONFIG.model_copy()
-        config.handler_url = f"{settings.HOST_URL}/api/bitrix24"
+        installed_hash = None if fresh_install else tokens.get("robot_config_hash")
+        if installed_hash == ROBOT_PAYLOAD_HASH and not force:
+            logger.info("Robot %s on %s is up to date, skipping", ROBOT_PAYLOAD["CODE"], domain)
+            return "skipped"
 
+        client = self._client_for(tokens)
         try:
-            await client.install_robot(config)
-            logger.info(f"Robot {config.code} installed successfully on {domain}")
+            status = await client.install_robot(ROBOT_PAYLOAD, update=installed_hash is not None)
+            logger.info("Robot %s %s successfully on %s", ROBOT_PAYLOAD["CODE"], status, domain)
         except Exception as e:
-            logger.error(f"Failed to install robot on {domain}: {e}")
+            logger.error("Failed to install robot on %s: %s", domain, e)
             raise
 
-    async def process_robot_request(self, event_token: str, data: ContactCreateDTO):
+        # Берем свежие токены: клиент (или другой воркер) мог их обновить во время установки
+        async with self.repo.lock(domain):
+            await self.repo.sync()
+            stored = await self.repo.load(domain=domain) or tokens
+            await self.repo.save({**stored, "robot_config_hash": ROBOT_PAYLOAD_HASH})
+        return status
+
+    async def resync_all(self, concurrency: int = None, force: bool = False) -> Dict[str, str]:
+        """
+        Перерегистрирует робота на всех известных порталах (не больше concurrency одновременно).
+
+        Returns:
+            dict: домен -> "skipped" / "added" / "updated" / "error: ...".
+        """
+        semaphore = asyncio.Semaphore(concurrency or settings.ROBOT_RESYNC_CONCURRENCY)
+
+        async def sync(tokens: dict) -> str:
+            async with semaphore:
+                try:
+                    fresh = await self.token_manager.get_tokens(domain=tokens["domain"])
+                    return await self.install_robot(tokens["domain"], fresh["access_token"], force=force)
+                except Exception as e:
+                    return f"error: {e}"
+
+        portals = [t for t in await self.repo.load_all() if t.get("domain")]
+        statuses = await asyncio.gather(*(sync(t) for t in portals))
+        return {t["domain"]: status for t, status in zip(portals, statuses)}
+
+    async def process_robot_request(self, event_token: str, data: ContactCreateDTO,
+                                    domain: Optional[str] = None, member_id: Optional[str] = None):
         """
             Основной сценарий выполнения робота
         Args:
             event_token (str): Токен события, пришедший от Битрикса (нужен для ответа).
             data (ContactCreateDTO): Валидированные данные контакта.
+            domain (str): Домен портала из auth[domain] вызова робота.
+            member_id (str): Идентификатор портала из auth[member_id].
 
         Steps:
-            1. Загружает токены из репозитория.
+            1. Загружает токены из репозитория (при необходимости обновляет их).
             2. Формирует поля для CRM.
         3. Создает контакт.
         4. Возвращает ID и сформированные данные обратно в процесс.
-        """
-        tokens = await self.repo.load()
-        if not tokens or "domain" not in tokens:
-            raise ValueError("Tokens missing or corrupted")
 
-        client = BitrixClient(self.http_client, tokens["domain"], tokens["access_token"])
+        Returns:
+            dict: Отправленные в процесс return_values.
 
-        logger.info(f"Processing request for: {data.first_name} {data.last_name}")
+        Raises:
+            ValueError: Не указан ни domain, ни member_id.
+        """
+        if not domain and not member_id:
+            raise ValueError("Robot call without domain and member_id")
+        ROBOT_IN_FLIGHT.inc()
+        try:
+            return await self._run_robot(event_token, data, domain, member_id)
+        finally:
+            ROBOT_IN_FLIGHT.dec()
 
-        crm_fields = {
-            "NAME": data.first_name,
-            "LAST_NAME": data.last_name,
-            "SECOND_NAME": data.second_name,
-            "TYPE_ID": "CLIENT"
-        }
-        if data.phone:
-            crm_fields["PHONE"] = [{"VALUE": data.phone, "VALUE_TYPE": "WORK"}]
-        if data.email:
-            crm_fields["EMAIL"] = [{"VALUE": data.email, "VALUE_TYPE": "WORK"}]
+    async def _run_robot(self, event_token: str, data: ContactCreateDTO,
+                         domain: Optional[str], member_id: Optional[str]) -> dict:
+        client = await self.portal_client(domain=domain, member_id=member_id)
+
+        logger.info("Processing request for: %s %s", data.first_name, data.last_name)
 
-        contact_id = await client.add_contact(crm_fields)
+        crm_fields = build_crm_fields(data)
 
         full_name_parts = [data.last_name, data.first_name, data.second_name]
         full_name = " ".join([p for p in full_name_parts if p]).strip()
 
         return_values = {
-            "created_contact_id": contact_id,
             "res_name": data.first_name,
             "res_last_name": data.last_name,
             "res_second_name": data.second_name,
@@ -84,4 +179,34 @@ class RobotService:
             "res_email": data.email
         }
 
-        await client.send_robot_result(event_token, return_values)
\ No newline at end of file
+        if self.contact_index is not None:
+            contact_id = await self._find_existing_contact(client, client.domain, data)
+            if contact_id:
+                logger.info("Contact %s already exists on %s, skipping crm.contact.add", contact_id, client.domain)
+                return_values["created_contact_id"] = contact_id
+                await client.send_robot_result(event_token, return_values)
+                return return_values
+
+        # created_contact_id подставляется из результата crm.contact.add
+        contact_id = await client.add_contact_and_send_result(crm_fields, event_token, return_values)
+        if self.contact_index is not None and contact_id:
+            await self.contact_index.remember(client.domain, contact_keys(data.phone, data.email), contact_id)
+        return {**return_values, "created_contact_id": contact_id}
+
+    async def _find_existing_contact(self, client: BitrixClient, domain: str,
+                                     data: ContactCreateDTO) -> Optional[int]:
+        """Сначала локальный индекс, при промахе — один поиск дублей на портале."""
+        keys = contact_keys(data.phone, data.email)
+        if not keys:
+            return None
+        contact_id = self.contact_index.lookup(domain, keys)
+        if contact_id:
+            return contact_id
+
+        # Телефон ищем и в исходном виде, и в E.164 — на портале он может быть записан как угодно
+        phone, email = normalize_phone(data.phone), normalize_email(data.email)
+        phones = list(dict.fromkeys([data.phone, phone])) if phone else []
+        contact_id = await client.find_contact_by_comm(phones, [email] if email else [])
+        if contact_id:
+            await self.contact_index.remember(domain, keys, contact_id)
+        return contact_id
\ No newline at end of file
@@ -0,0 +1,164 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты очереди: меньше — раньше
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Ответ робота ждет бизнес-процесс, поэтому он обгоняет остальные вызовы
+HIGH_PRIORITY_METHODS = {"bizproc.event.send"}
+
+# После 503 без Retry-After скорость падает вдвое, но не ниже этой доли от rate,
+# а каждый успешный ответ возвращает RECOVERY_STEP от rate
+MIN_RATE_FACTOR = 0.25
+RECOVERY_STEP = 0.25
+
+
+class RateLimitExceeded(Exception):
+    """Запрос не дождался своей очереди к порталу (очередь переполнена или истек дедлайн)."""
+
+
+def method_priority(method: str, json_data: Optional[dict] = None) -> int:
+    if method in HIGH_PRIORITY_METHODS:
+        return PRIORITY_HIGH
+    if method == "batch" and json_data:
+        commands = (json_data.get("cmd") or {}).values()
+        if any(str(c).split("?", 1)[0] in HIGH_PRIORITY_METHODS for c in commands):
+            return PRIORITY_HIGH
+    return PRIORITY_NORMAL
+
+
+class PortalRateLimiter:
+    """
+    Token bucket для одного портала с приоритетной очередью ожидания.
+    - rate запросов в секунду, не больше burst подряд.
+    - Ответ 503 QUERY_LIMIT_EXCEEDED с Retry-After ставит портал на паузу ровно на это время
+      (плюс небольшой джиттер), скорость не меняется.
+    - Без Retry-After — экспоненциальная пауза с джиттером, сброс накопленных токенов и снижение
+      скорости вдвое (не ниже MIN_RATE_FACTOR * rate); успешные ответы быстро возвращают ее к rate.
+    - Запрос ждет в ограниченной очереди до своего дедлайна, а не падает сразу.
+    - При нескольких воркерах (SERVER_WORKERS) каждый получает свою долю лимита портала.
+    """
+    def __init__(self, domain: str, rate: float = None, burst: int = None, max_queue: int = None):
+        self.domain = domain
+        workers = max(1, settings.SERVER_WORKERS)
+        self.rate = settings.BITRIX_RATE_LIMIT_RATE / workers if rate is None else rate
+        self.burst = max(1, settings.BITRIX_RATE_LIMIT_BURST // workers) if burst is None else burst
+        self.max_queue = settings.BITRIX_RATE_LIMIT_MAX_QUEUE if max_queue is None else max_queue
+        self.current_rate = self.rate
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._failures = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.current_rate)
+        self._updated_at = now
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL, deadline: Optional[float] = None):
+        """Ждет разрешения на один запрос к порталу (не дольше deadline по time.monotonic())."""
+        now = time.monotonic()
+        self._refill(now)
+        if not self._waiters and now >= self._paused_until and self._tokens >= 1:
+            self._tokens -= 1
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            raise RateLimitExceeded(f"Request queue for {self.domain} is full ({self.max_queue})")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+        timeout = None if deadline is None else max(0.0, deadline - now)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise RateLimitExceeded(f"Timed out waiting for rate limit slot on {self.domain}") from None
+
+    async def _dispatch(self):
+        while self._waiters:
+            # Отмененные ожидания (таймаут) просто выбрасываем
+            while self._waiters and self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+            if not self._waiters:
+                break
+
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.current_rate)
+                continue
+
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._tokens -= 1
+                future.set_result(None)
+
+    def penalize(self, retry_after: Optional[float] = None) -> float:
+        """
+        Реакция на QUERY_LIMIT_EXCEEDED.
+        Returns:
+            float: пауза в секундах до следующего запроса к порталу.
+        """
+        now = time.monotonic()
+        if retry_after is None and now < self._paused_until:
+            # 503 на запросы, отправленные до начала паузы, — это та же перегрузка, а не новая
+            return self._paused_until - now
+        self._failures += 1
+        if retry_after is not None:
+            # Портал сам сказал, когда можно продолжать: джиттер только разводит воркеры
+            delay = retry_after * random.uniform(1.0, 1.1)
+        else:
+            delay = min(settings.BITRIX_RATE_LIMIT_BACKOFF_BASE * (2 ** (self._failures - 1)),
+                        settings.BITRIX_RATE_LIMIT_BACKOFF_MAX) * random.uniform(1.0, 1.5)
+            # Подсказки нет: считаем, что запас портала исчерпан, и идем медленнее
+            self._tokens = 0.0
+            self.current_rate = max(self.rate * MIN_RATE_FACTOR, self.current_rate / 2)
+        self._paused_until = max(self._paused_until, now + delay)
+        return delay
+
+    def record_success(self):
+        self._failures = 0
+        if self.current_rate < self.rate:
+            self.current_rate = min(self.rate, self.current_rate + self.rate * RECOVERY_STEP)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "queued": len(self._waiters),
+            "tokens": round(self._tokens, 2),
+            "current_rate": round(self.current_rate, 3),
+            "paused_for": round(max(0.0, self._paused_until - time.monotonic()), 3)
+        }
+
+
+# Лимитеры по доменам порталов: у каждого портала своя очередь,
+# поэтому медленный портал не задерживает запросы к другим
+_limiters: Dict[str, PortalRateLimiter] = {}
+
+
+def get_rate_limiter(domain: str) -> PortalRateLimiter:
+    limiter = _limiters.get(domain)
+    if limiter is None:
+        limiter = _limiters[domain] = PortalRateLimiter(domain)
+    return limiter
+
+
+def rate_limiter_stats() -> Dict[str, Dict[str, float]]:
+    return {domain: limiter.stats() for domain, limiter in _limiters.items()}
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+import httpx
+from typing import Dict, Optional
+from repositories.file_lock import FileLockTimeout
+from repositories.token_store import ITokenRepository
+from config import settings
+from logging_config import create_shared_task, log_context
+
+logger = logging.getLogger(__name__)
+
+# Обновления токенов, которые выполняются прямо сейчас (ключ — домен портала).
+# Общий на процесс: все запросы, упершиеся в истекший токен, ждут одно и то же обновление.
+_inflight_refreshes: Dict[str, asyncio.Future] = {}
+
+
+class TokenRefreshError(Exception):
+    """Не удалось обновить access_token по refresh_token."""
+
+
+class TokenManager:
+    """
+    Выдает актуальные токены портала.
+    - Заранее обновляет access_token, если до истечения осталось меньше refresh_margin секунд.
+    - Обновляет токен по требованию (после ответа expired_token от Bitrix).
+    - Одновременные обновления для одного портала схлопываются в один запрос к OAuth-серверу,
+      иначе параллельные обновления инвалидировали бы refresh_token друг друга.
+      Внутри процесса — общей задачей, между воркерами — блокировкой портала в хранилище токенов.
+    """
+    def __init__(self, repo: ITokenRepository, http_client: httpx.AsyncClient, refresh_margin: float = None):
+        self.repo = repo
+        self.http_client = http_client
+        self.refresh_margin = settings.TOKEN_REFRESH_MARGIN if refresh_margin is None else refresh_margin
+
+    async def get_tokens(self, domain: Optional[str] = None, member_id: Optional[str] = None) -> Optional[dict]:
+        tokens = await self.repo.load(domain=domain, member_id=member_id)
+        if not tokens or "domain" not in tokens:
+            return tokens
+
+        expires = tokens.get("expires")
+        if expires and tokens.get("refresh_token") and float(expires) - time.time() < self.refresh_margin:
+            try:
+                return await self.refresh(tokens)
+            except TokenRefreshError as e:
+                # Токен может быть еще жив — пусть запрос попробует, а при ошибке обновит повторно
+                logger.warning("Proactive token refresh failed for %s: %s", tokens["domain"], e)
+        return tokens
+
+    async def refresh(self, stale_tokens: dict) -> dict:
+        """
+        Обновляет токены, которые вызывающий считает устаревшими.
+        Если за это время токен уже обновил кто-то другой, возвращает сохраненные токены без запроса.
+        """
+        domain = stale_tokens["domain"]
+        task = _inflight_refreshes.get(domain)
+        if task is None:
+            task = create_shared_task(self._do_refresh(stale_tokens))
+            _inflight_refreshes[domain] = task
+            task.add_done_callback(lambda _: _inflight_refreshes.pop(domain, None))
+        # shield: отмена одного из ожидающих не должна отменять обновление для остальных
+        return await asyncio.shield(task)
+
+    async def _do_refresh(self, stale_tokens: dict) -> dict:
+        try:
+            with log_context(portal=stale_tokens["domain"]):
+                # Блокируется только этот портал: медленный OAuth-сервер не задерживает остальные
+                async with self.repo.lock(stale_tokens["domain"]):
+                    # Другой воркер мог обновить токен, пока мы ждали блокировку
+                    await self.repo.sync()
+                    return await self._refresh_locked(stale_tokens)
+        except FileLockTimeout as e:
+            raise TokenRefreshError(str(e)) from e
+
+    async def _refresh_locked(self, stale_tokens: dict) -> dict:
+        current = await self.repo.load(domain=stale_tokens["domain"]) or {}
+        if current.get("access_token") not in (None, stale_tokens.get("access_token")):
+            logger.info("Token for %s was already refreshed", stale_tokens["domain"])
+            return current
+
+        refresh_token = current.get("refresh_token") or stale_tokens.get("refresh_token")
+        if not refresh_token:
+            raise TokenRefreshError(f"No refresh_token for {stale_tokens['domain']}")
+
+        payload = {
+            "grant_type": "refresh_token",
+            "client_id": settings.CLIENT_ID,
+            "client_secret": settings.CLIENT_SECRET,
+            "refresh_token": refresh_token
+        }
+        try:
+            resp = await self.http_client.post(f"{settings.BITRIX_OAUTH_URL}/oauth/token/", data=payload)
+        except httpx.RequestError as e:
+            raise TokenRefreshError(f"Network error: {e}") from e
+        if resp.status_code != 200:
+            raise TokenRefreshError(f"OAuth server answered {resp.status_code}: {resp.text}")
+
+        data = resp.json()
+        if "access_token" not in data:
+            raise TokenRefreshError(f"Unexpected OAuth response: {data}")
+
+        tokens = {**stale_tokens, **current, **data}
+        # В ответе OAuth-сервера domain = oauth.bitrix.info, сохраняем домен портала
+        tokens["domain"] = stale_tokens["domain"]
+        if "expires" not in data and data.get("expires_in"):
+            tokens["expires"] = int(time.time()) + int(data["expires_in"])
+
+        await self.repo.save(tokens)
+        logger.info("Access token refreshed for %s", tokens["domain"])
+        return tokens
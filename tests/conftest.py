@@ -0,0 +1,6 @@
+import os
+
+# Обязательные настройки (config.Settings) для импорта модулей приложения без .env
+os.environ.setdefault("CLIENT_ID", "test-client")
+os.environ.setdefault("CLIENT_SECRET", "test-secret")
+os.environ.setdefault("HOST_URL", "http://localhost:8000")
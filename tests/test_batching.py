@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import pytest
+from urllib.parse import parse_qs
+from logging_config import event_token_var, log_context, request_id_var
+from services.batching import BitrixBatchError, BitrixBatcher, split_stages
+
+
+class FakeClient:
+    """Отвечает на batch.json как Битрикс; crm.contact.add с LAST_NAME=bad завершается ошибкой."""
+    domain = "a.bitrix24.ru"
+
+    def __init__(self):
+        self.batches = []
+
+    async def _post(self, method, json_data=None, priority=None):
+        assert method == "batch" and json_data["halt"] == 0
+        self.batches.append(json_data["cmd"])
+        results, errors = {}, {}
+        for key, command in json_data["cmd"].items():
+            method, _, query = command.partition("?")
+            params = parse_qs(query)
+            if method == "crm.contact.add" and params.get("fields[LAST_NAME]") == ["bad"]:
+                errors[key] = {"error": "ERROR_CORE"}
+            else:
+                results[key] = len(results) + 100
+        return {"result": {"result": results, "result_error": errors}}
+
+
+def chain(last_name):
+    return [
+        ("contact", "crm.contact.add", {"fields": {"LAST_NAME": last_name}}),
+        ("event", "bizproc.event.send", {"event_token": last_name, "return_values": {"id": "$result[contact]"}}),
+    ]
+
+
+def test_split_stages():
+    assert [[name for name, _, _ in stage] for stage in split_stages(chain("x"))] == [["contact"], ["event"]]
+    independent = [("a", "m", {}), ("b", "m", {"x": 1})]
+    assert split_stages(independent) == [independent]
+
+
+def test_dependent_command_is_not_sent_after_failure():
+    """Если crm.contact.add не выполнился, bizproc.event.send не уходит со ссылкой $result[...]."""
+    async def scenario():
+        client = FakeClient()
+        batcher = BitrixBatcher(window=0.01, max_commands=50)
+        good, bad = await asyncio.gather(batcher.submit(client, chain("good")),
+                                         batcher.submit(client, chain("bad")),
+                                         return_exceptions=True)
+        assert isinstance(bad, BitrixBatchError) and bad.method == "crm.contact.add"
+        assert good["event"] is not None
+
+        # Первый batch — оба контакта, второй — только результат успешного вызова
+        assert len(client.batches) == 2 and len(client.batches[0]) == 2
+        events = list(client.batches[1].values())
+        assert len(events) == 1 and "event_token=good" in events[0]
+        assert f"return_values%5Bid%5D={good['contact']}" in events[0]
+        assert all("$result" not in command for batch in client.batches for command in batch.values())
+
+    asyncio.run(scenario())
+
+
+def test_chain_longer_than_batch_is_rejected():
+    async def scenario():
+        with pytest.raises(ValueError):
+            await BitrixBatcher(window=0.01, max_commands=1).submit(FakeClient(), chain("x"))
+
+    asyncio.run(scenario())
+
+
+def test_shared_batch_does_not_inherit_caller_context(caplog):
+    """Общий batch не приписывается запросу, который первым поставил команду в очередь."""
+    async def scenario():
+        client = FakeClient()
+        seen = []
+        post = client._post
+
+        async def traced_post(method, json_data=None, priority=None):
+            seen.append((request_id_var.get(), event_token_var.get()))
+            return await post(method, json_data, priority)
+
+        client._post = traced_post
+        batcher = BitrixBatcher(window=0.01, max_commands=50)
+
+        async def call(token):
+            request_id_var.set(f"req-{token}")
+            with log_context(portal=client.domain, event_token=token):
+                return await batcher.submit(client, [("contact", "crm.contact.add", {"fields": {"LAST_NAME": token}})])
+
+        with caplog.at_level(logging.INFO, logger="services.batching"):
+            await asyncio.gather(call("evt-1"), call("evt-2"))
+        assert seen == [(None, None)]
+        assert "evt-1" in caplog.text and "evt-2" in caplog.text
+
+    asyncio.run(scenario())
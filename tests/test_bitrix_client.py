@@ -0,0 +1,33 @@
+import asyncio
+from services.bitrix_client import BitrixClient
+
+
+def test_find_contact_by_comm_is_one_request_without_batching():
+    """Телефон и email проверяются одним batch.json даже при выключенном микро-батчинге."""
+    calls = []
+
+    async def post(method, json_data=None, priority=None):
+        calls.append((method, json_data))
+        return {"result": {"result": {"phone": [], "email": {"CONTACT": [42, 17]}}, "result_error": []}}
+
+    async def scenario():
+        client = BitrixClient(None, "a.bitrix24.ru", "token")
+        client._post = post
+        return await client.find_contact_by_comm(["+79991234567"], ["a@example.com"], batch=False)
+
+    assert asyncio.run(scenario()) == 17
+    assert [method for method, _ in calls] == ["batch"]
+    assert set(calls[0][1]["cmd"]) == {"phone", "email"}
+
+
+def test_find_contact_by_comm_compares_ids_as_numbers():
+    """Битрикс может вернуть id строками: "10" < "9" как строки, но старший контакт — 9."""
+    async def post(method, json_data=None, priority=None):
+        return {"result": {"result": {"phone": {"CONTACT": ["10", "9"]}, "email": []}, "result_error": []}}
+
+    async def scenario():
+        client = BitrixClient(None, "a.bitrix24.ru", "token")
+        client._post = post
+        return await client.find_contact_by_comm(["+79991234567"], ["a@example.com"], batch=False)
+
+    assert asyncio.run(scenario()) == 9
@@ -0,0 +1,57 @@
+import asyncio
+import os
+from config import settings
+from services import contact_import
+from services.contact_import import import_paths, new_import_id, source_paths, start_import
+
+
+def test_api_upload_resolves_to_api_paths():
+    """import-contacts для файла, загруженного через API, продолжает тот же checkpoint."""
+    import_id = new_import_id()
+    paths = import_paths(import_id, "csv")
+    assert source_paths(paths["source"]) == paths
+    assert source_paths(os.path.abspath(paths["source"]))["checkpoint"] == paths["checkpoint"]
+
+
+def test_other_files_use_suffixed_paths(tmp_path):
+    source = str(tmp_path / "contacts.csv")
+    assert source_paths(source)["checkpoint"] == f"{source}.checkpoint.json"
+    # Имя как у API-импорта, но вне IMPORT_DIR
+    foreign = str(tmp_path / f"{new_import_id()}.csv")
+    assert os.path.abspath(settings.IMPORT_DIR) != str(tmp_path)
+    assert source_paths(foreign)["results"] == f"{foreign}.results.jsonl"
+
+
+def test_imports_into_one_portal_share_concurrency(tmp_path, monkeypatch):
+    """Два импорта в один портал вместе держат не больше IMPORT_CONCURRENCY batch-запросов."""
+    monkeypatch.setattr(settings, "IMPORT_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "IMPORT_CONCURRENCY", 2)
+    monkeypatch.setattr(settings, "IMPORT_CHUNK_SIZE", 1)
+    monkeypatch.setattr(contact_import, "_portal_slots", {})
+    in_flight = {"now": 0, "max": 0}
+
+    class Client:
+        async def call_batch(self, commands):
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+            await asyncio.sleep(0.01)
+            in_flight["now"] -= 1
+            return {name: 1 for name, _, _ in commands}, {}
+
+    class Service:
+        async def portal_client(self, domain=None, member_id=None):
+            return Client()
+
+    async def scenario():
+        importers = []
+        for _ in range(2):
+            import_id = new_import_id()
+            with open(import_paths(import_id, "csv")["source"], "w", encoding="utf-8") as f:
+                f.write("LAST_NAME\n" + "".join(f"Name{i}\n" for i in range(10)))
+            importers.append(start_import(Service(), "a.bitrix24.ru", import_id, "csv"))
+        await asyncio.gather(*contact_import._imports.values())
+        return importers
+
+    importers = asyncio.run(scenario())
+    assert [importer.counts["created"] for importer in importers] == [10, 10]
+    assert in_flight["max"] == 2
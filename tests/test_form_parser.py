@@ -0,0 +1,25 @@
+from form_parser import parse_form, parse_robot_call
+
+
+def test_indexes_keep_their_positions():
+    assert parse_form(b"p[1]=b&p[0]=a") == {"p": ["a", "b"]}
+    assert parse_form(b"p[]=a&p[]=b") == {"p": ["a", "b"]}
+    assert parse_form(b"p[0][a]=1&p[1][a]=2") == {"p": [{"a": "1"}, {"a": "2"}]}
+
+
+def test_sparse_indexes_are_not_lost():
+    """p[0]=a&p[5]=b&p[1]=c: значение с индексом 5 не пропадает и не сдвигает соседей."""
+    assert parse_form(b"p[0]=a&p[5]=b&p[1]=c") == {"p": {"0": "a", "5": "b", "1": "c"}}
+    assert parse_form(b"p[5]=a&p[]=b") == {"p": {"5": "a", "6": "b"}}
+
+
+def test_robot_call_keeps_only_string_values():
+    """Вложенные значения вместо строк не попадают в RobotCallPayload (model_construct их не проверяет)."""
+    call = parse_robot_call(
+        b"event_token[x]=1&properties[LAST_NAME][x]=1&properties[NAME]=n"
+        b"&auth[domain][]=d&auth[member_id]=m&document_id[0]=crm&document_id[1][x]=1"
+    )
+    assert call.event_token is None
+    assert call.properties == {"NAME": "n"}
+    assert call.auth.domain is None and call.auth.member_id == "m"
+    assert call.document_id == ["crm"]
@@ -0,0 +1,101 @@
+import asyncio
+import time
+import pytest
+from services.idempotency import IdempotencyGuard
+
+
+def test_expired_records_are_purged_while_running(tmp_path):
+    """Записи старше TTL удаляются не только при старте, но и во время работы."""
+    async def scenario():
+        guard = IdempotencyGuard(str(tmp_path / "idempotency.db"), cache_size=10, ttl=0.05, purge_interval=0.05)
+        await guard.init()
+
+        async def outcome():
+            return {"ok": True}
+
+        await guard.run("evt-1", outcome)
+        await asyncio.sleep(0.1)
+        await guard.run("evt-2", outcome)
+        await guard._purge_task
+
+        rows = await guard.db.execute("SELECT event_token FROM processed_events")
+        assert [row["event_token"] for row in rows] == ["evt-2"]
+        await guard.close()
+
+    asyncio.run(scenario())
+
+
+def test_retry_in_another_worker_waits_for_the_original(tmp_path):
+    """Повтор, попавший в другой процесс во время выполнения оригинала, не выполняет вызов второй раз."""
+    path = str(tmp_path / "idempotency.db")
+
+    async def scenario():
+        first, second = IdempotencyGuard(path, poll_interval=0.01), IdempotencyGuard(path, poll_interval=0.01)
+        await first.init()
+        await second.init()
+        calls = []
+
+        async def slow():
+            calls.append("call")
+            await asyncio.sleep(0.1)
+            return {"created_contact_id": 7}
+
+        original = asyncio.create_task(first.run("evt-1", slow))
+        await asyncio.sleep(0.02)
+        retry = await second.run("evt-1", slow)
+
+        assert retry == await original == {"created_contact_id": 7}
+        assert calls == ["call"]
+        assert second.stats()["waited"] == 1
+        await first.close()
+        await second.close()
+
+    asyncio.run(scenario())
+
+
+def test_failed_original_lets_the_retry_run(tmp_path):
+    path = str(tmp_path / "idempotency.db")
+
+    async def scenario():
+        first, second = IdempotencyGuard(path, poll_interval=0.01), IdempotencyGuard(path, poll_interval=0.01)
+        await first.init()
+        await second.init()
+
+        async def failing():
+            await asyncio.sleep(0.05)
+            raise RuntimeError("portal is down")
+
+        async def succeeding():
+            return {"ok": True}
+
+        original = asyncio.create_task(first.run("evt-1", failing))
+        await asyncio.sleep(0.01)
+        assert await second.run("evt-1", succeeding) == {"ok": True}
+        with pytest.raises(RuntimeError):
+            await original
+        await first.close()
+        await second.close()
+
+    asyncio.run(scenario())
+
+
+def test_abandoned_claim_is_taken_over(tmp_path):
+    """Строка pending упавшего воркера не блокирует event_token дольше pending_timeout."""
+    path = str(tmp_path / "idempotency.db")
+
+    async def scenario():
+        guard = IdempotencyGuard(path, pending_timeout=0.05, poll_interval=0.01)
+        await guard.init()
+        await guard.db.execute(
+            "INSERT INTO processed_events (event_token, outcome, created_at, pending) VALUES ('evt-1', 'null', ?, 1)",
+            (time.time(),)
+        )
+
+        async def outcome():
+            return {"ok": True}
+
+        assert await guard.run("evt-1", outcome) == {"ok": True}
+        assert guard.stats()["misses"] == 1
+        await guard.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,70 @@
+import asyncio
+import sqlite3
+from services.job_queue import JobQueue
+
+
+def test_init_keeps_jobs_with_live_lease(tmp_path):
+    """Запуск второго воркера не возвращает в очередь задачу, которую выполняет первый."""
+    path = str(tmp_path / "jobs.db")
+
+    async def scenario():
+        first = JobQueue(path, lease_timeout=60)
+        await first.init()
+        await first.enqueue("evt-1", {"event_token": "evt-1"})
+        job = await first.claim()
+        assert job is not None
+
+        second = JobQueue(path, lease_timeout=60)
+        await second.init()
+        assert await second.claim() is None
+        assert (await second.stats())["running"] == 1
+        await first.close()
+        await second.close()
+
+    asyncio.run(scenario())
+
+
+def test_expired_lease_is_requeued(tmp_path):
+    path = str(tmp_path / "jobs.db")
+
+    async def scenario():
+        queue = JobQueue(path, lease_timeout=0.05)
+        await queue.init()
+        await queue.enqueue("evt-1", {"event_token": "evt-1"})
+        job = await queue.claim()
+
+        await asyncio.sleep(0.03)
+        await queue.heartbeat([job["id"]])
+        await asyncio.sleep(0.03)
+        assert await queue.requeue_expired() == 0
+
+        await asyncio.sleep(0.06)
+        assert await queue.requeue_expired() == 1
+        assert (await queue.claim())["id"] == job["id"]
+        await queue.close()
+
+    asyncio.run(scenario())
+
+
+def test_init_migrates_old_schema(tmp_path):
+    """Базы без колонок аренды дополняются; их running-задачи считаются брошенными."""
+    path = str(tmp_path / "jobs.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        "CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, event_token TEXT UNIQUE, "
+        "payload TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+        "next_run_at REAL NOT NULL, created_at REAL NOT NULL, last_error TEXT);"
+        "INSERT INTO jobs (event_token, payload, status, next_run_at, created_at) "
+        "VALUES ('evt-1', '{}', 'running', 0, 0);"
+    )
+    conn.commit()
+    conn.close()
+
+    async def scenario():
+        queue = JobQueue(path, lease_timeout=60)
+        await queue.init()
+        job = await queue.claim()
+        assert job is not None and job["event_token"] == "evt-1"
+        await queue.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,18 @@
+import logging
+from logging_config import ContextFilter, log_context, portal_var
+
+
+def _record() -> logging.LogRecord:
+    record = logging.LogRecord("test", logging.INFO, __file__, 0, "message", (), None)
+    ContextFilter().filter(record)
+    return record
+
+
+def test_log_context_does_not_leak_between_jobs():
+    """Задача без домена не получает портал предыдущей задачи того же воркера."""
+    with log_context(portal="a.bitrix24.ru", event_token="evt-1"):
+        assert _record().portal == "a.bitrix24.ru"
+    with log_context(portal=None, event_token="evt-2"):
+        record = _record()
+        assert record.portal is None and record.event_token == "evt-2"
+    assert portal_var.get() is None
@@ -0,0 +1,55 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from metrics import HTTP_REQUEST_DURATION, MetricsMiddleware, MetricsRegistry
+
+
+def test_render_prometheus_text_format():
+    registry = MetricsRegistry()
+    errors = registry.counter("errors_total", "Errors", ("kind",))
+    latency = registry.histogram("latency_seconds", "Latency", ("method",), buckets=(0.1, 1.0))
+    in_flight = registry.gauge("in_flight", "In flight", collect=lambda: {(): 3})
+
+    errors.inc('say "hi"\n')
+    for value in (0.05, 0.1, 0.5, 2.0):
+        latency.observe(value, "GET")
+
+    assert registry.render().splitlines() == [
+        "# HELP errors_total Errors",
+        "# TYPE errors_total counter",
+        'errors_total{kind="say \\"hi\\"\\n"} 1.0',
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        # Граница корзины включительная (le), значения накопительные
+        'latency_seconds_bucket{method="GET",le="0.1"} 2',
+        'latency_seconds_bucket{method="GET",le="1.0"} 3',
+        'latency_seconds_bucket{method="GET",le="+Inf"} 4',
+        'latency_seconds_sum{method="GET"} 2.65',
+        'latency_seconds_count{method="GET"} 4',
+        "# HELP in_flight In flight",
+        "# TYPE in_flight gauge",
+        "in_flight 3",
+    ]
+    assert registry.render().endswith("\n")
+
+
+def test_middleware_labels_by_route_template():
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int):
+        return {"id": item_id}
+
+    HTTP_REQUEST_DURATION._series.clear()
+    with TestClient(app) as client:
+        for item_id in (1, 2, 3):
+            assert client.get(f"/items/{item_id}").status_code == 200
+        assert client.get("/items/abc").status_code == 422
+        assert client.get("/missing").status_code == 404
+
+    counts = {labels: sum(counts) for labels, (counts, _) in HTTP_REQUEST_DURATION._series.items()}
+    assert counts == {
+        ("GET", "/items/{item_id}", "200"): 3,
+        ("GET", "/items/{item_id}", "422"): 1,
+        ("GET", "unmatched", "404"): 1,
+    }
@@ -0,0 +1,85 @@
+import asyncio
+import json
+import httpx
+import pytest
+from repositories.token_store import JsonTokenRepository
+from services.processing import ROBOT_PAYLOAD_HASH, RobotService
+
+DOMAIN = "robot.bitrix24.ru"
+
+
+def run_install(tmp_path, stored_hash=None, errors=None, **kwargs):
+    """
+    Устанавливает робота на портал с сохраненным хэшем stored_hash.
+    errors: метод -> код ошибки Bitrix24, которым портал ответит на этот метод.
+
+    Returns:
+        tuple: (статус установки, вызванные REST-методы, сохраненные токены).
+    """
+    errors = errors or {}
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        method = request.url.path.rsplit("/", 1)[-1].removesuffix(".json")
+        calls.append(method)
+        if method in errors:
+            return httpx.Response(400, json={"error": errors[method], "error_description": "test"})
+        return httpx.Response(200, json={"result": True})
+
+    async def scenario():
+        repo = JsonTokenRepository(str(tmp_path / "tokens.json"))
+        tokens = {"domain": DOMAIN, "access_token": "token", "refresh_token": "refresh"}
+        if stored_hash:
+            tokens["robot_config_hash"] = stored_hash
+        await repo.save(tokens)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+            status = await RobotService(repo, http_client).install_robot(DOMAIN, **kwargs)
+        return status, calls, await repo.load(domain=DOMAIN)
+
+    return asyncio.run(scenario())
+
+
+def test_same_fingerprint_is_skipped(tmp_path):
+    status, calls, _ = run_install(tmp_path, stored_hash=ROBOT_PAYLOAD_HASH)
+    assert status == "skipped"
+    assert calls == []
+
+
+def test_force_reinstalls_same_fingerprint(tmp_path):
+    status, calls, _ = run_install(tmp_path, stored_hash=ROBOT_PAYLOAD_HASH, force=True)
+    assert status == "updated"
+    assert calls == ["bizproc.robot.update"]
+
+
+def test_fresh_install_adds(tmp_path):
+    status, calls, tokens = run_install(tmp_path, stored_hash="old", fresh_install=True)
+    assert status == "added"
+    assert calls == ["bizproc.robot.add"]
+    assert tokens["robot_config_hash"] == ROBOT_PAYLOAD_HASH
+
+
+def test_changed_fingerprint_updates(tmp_path):
+    status, calls, tokens = run_install(tmp_path, stored_hash="old")
+    assert status == "updated"
+    assert calls == ["bizproc.robot.update"]
+    assert tokens["robot_config_hash"] == ROBOT_PAYLOAD_HASH
+
+
+def test_update_of_missing_robot_falls_back_to_add(tmp_path):
+    status, calls, _ = run_install(tmp_path, stored_hash="old",
+                                   errors={"bizproc.robot.update": "ERROR_ACTIVITY_NOT_FOUND"})
+    assert status == "added"
+    assert calls == ["bizproc.robot.update", "bizproc.robot.add"]
+
+
+def test_add_of_installed_robot_falls_back_to_update(tmp_path):
+    status, calls, _ = run_install(tmp_path, errors={"bizproc.robot.add": "ERROR_ACTIVITY_ALREADY_INSTALLED"})
+    assert status == "updated"
+    assert calls == ["bizproc.robot.add", "bizproc.robot.update"]
+
+
+def test_other_error_is_raised_and_hash_not_saved(tmp_path):
+    with pytest.raises(httpx.HTTPStatusError):
+        run_install(tmp_path, stored_hash="old", errors={"bizproc.robot.update": "ACCESS_DENIED"})
+    with open(tmp_path / "tokens.json", encoding="utf-8") as f:
+        assert json.load(f)["robot_config_hash"] == "old"
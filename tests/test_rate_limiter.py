@@ -0,0 +1,84 @@
+import asyncio
+import time
+import pytest
+from services.rate_limiter import (MIN_RATE_FACTOR, PRIORITY_HIGH, PRIORITY_NORMAL, PortalRateLimiter,
+                                   RateLimitExceeded, method_priority)
+
+
+def test_high_priority_overtakes_queued_calls():
+    async def scenario():
+        limiter = PortalRateLimiter("a.bitrix24.ru", rate=50, burst=1, max_queue=10)
+        await limiter.acquire()
+        order = []
+
+        async def call(name, priority):
+            await limiter.acquire(priority)
+            order.append(name)
+
+        tasks = [asyncio.create_task(call("normal-1", PRIORITY_NORMAL)),
+                 asyncio.create_task(call("normal-2", PRIORITY_NORMAL))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(call("event", PRIORITY_HIGH)))
+        await asyncio.gather(*tasks)
+        assert order == ["event", "normal-1", "normal-2"]
+
+    asyncio.run(scenario())
+
+
+def test_method_priority():
+    assert method_priority("bizproc.event.send") == PRIORITY_HIGH
+    assert method_priority("batch", {"cmd": {"a": "crm.contact.add?x=1", "b": "bizproc.event.send?y=2"}}) == PRIORITY_HIGH
+    assert method_priority("crm.contact.add") == PRIORITY_NORMAL
+
+
+def test_deadline_and_full_queue_raise():
+    async def scenario():
+        limiter = PortalRateLimiter("a.bitrix24.ru", rate=1, burst=1, max_queue=1)
+        await limiter.acquire()
+        started = time.monotonic()
+        with pytest.raises(RateLimitExceeded):
+            await limiter.acquire(deadline=time.monotonic() + 0.05)
+        assert time.monotonic() - started < 0.5
+
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(RateLimitExceeded):
+            await limiter.acquire()
+        waiting.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_retry_after_pauses_without_slowing_down():
+    """Два 503 с Retry-After 0.2 с: пауза ~0.2 с, дальше портал опрашивается с прежней скоростью."""
+    async def scenario():
+        limiter = PortalRateLimiter("a.bitrix24.ru", rate=2, burst=50, max_queue=10)
+        for _ in range(2):
+            delay = limiter.penalize(0.2)
+            assert 0.2 <= delay <= 0.22
+        assert limiter.current_rate == 2
+
+        started = time.monotonic()
+        for _ in range(5):
+            await limiter.acquire()
+        assert 0.15 <= time.monotonic() - started < 1.0
+
+    asyncio.run(scenario())
+
+
+def test_backoff_without_retry_after_slows_down_and_recovers():
+    limiter = PortalRateLimiter("a.bitrix24.ru", rate=2, burst=50, max_queue=10)
+    first = limiter.penalize()
+    # Остальные 503 той же перегрузки (запросы были уже в пути) паузу не удлиняют
+    assert limiter.penalize() <= first
+    limiter._paused_until = 0.0
+    assert limiter.penalize() > first
+    for _ in range(5):
+        limiter._paused_until = 0.0
+        limiter.penalize()
+    assert limiter.current_rate == 2 * MIN_RATE_FACTOR
+    assert limiter.stats()["tokens"] == 0
+
+    for _ in range(3):
+        limiter.record_success()
+    assert limiter.current_rate == 2
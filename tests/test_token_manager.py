@@ -0,0 +1,102 @@
+import asyncio
+import time
+import httpx
+import pytest
+from repositories.token_store import CachedJsonTokenRepository
+from services.token_manager import TokenManager, TokenRefreshError
+
+DOMAIN = "a.bitrix24.ru"
+
+
+class OAuthServer:
+    """Заглушка oauth/token/: считает запросы; пока fail=True, отвечает 500."""
+    def __init__(self):
+        self.requests = 0
+        self.fail = False
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        await asyncio.sleep(0.05)
+        if self.fail:
+            return httpx.Response(500, text="server error")
+        return httpx.Response(200, json={
+            "access_token": f"access-{self.requests}", "refresh_token": f"refresh-{self.requests}",
+            "expires_in": 3600, "domain": "oauth.bitrix.info"
+        })
+
+
+async def _manager(tmp_path, server: OAuthServer):
+    repo = CachedJsonTokenRepository(str(tmp_path / "tokens.json"), save_delay=0)
+    await repo.save({"domain": DOMAIN, "access_token": "stale", "refresh_token": "refresh-0",
+                     "expires": int(time.time()) - 10})
+    client = httpx.AsyncClient(transport=httpx.MockTransport(server.handler))
+    return TokenManager(repo, client), client
+
+
+def test_concurrent_expired_calls_refresh_once(tmp_path):
+    """20 одновременных запросов с истекшим токеном — один запрос к OAuth-серверу."""
+    async def scenario():
+        server = OAuthServer()
+        manager, client = await _manager(tmp_path, server)
+        results = await asyncio.gather(*(manager.get_tokens(domain=DOMAIN) for _ in range(20)))
+        await client.aclose()
+
+        assert server.requests == 1
+        assert {tokens["access_token"] for tokens in results} == {"access-1"}
+        assert results[0]["domain"] == DOMAIN
+        assert (await manager.repo.load(domain=DOMAIN))["refresh_token"] == "refresh-1"
+
+    asyncio.run(scenario())
+
+
+def test_refresh_of_already_refreshed_token_makes_no_request(tmp_path):
+    async def scenario():
+        server = OAuthServer()
+        manager, client = await _manager(tmp_path, server)
+        stale = await manager.repo.load(domain=DOMAIN)
+        await manager.refresh(stale)
+        # Запрос, который получил expired_token со старым токеном, уже после обновления
+        assert (await manager.refresh(stale))["access_token"] == "access-1"
+        assert server.requests == 1
+        await client.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_failed_refresh_reaches_every_waiter_and_is_not_cached(tmp_path):
+    async def scenario():
+        server = OAuthServer()
+        server.fail = True
+        manager, client = await _manager(tmp_path, server)
+        stale = await manager.repo.load(domain=DOMAIN)
+
+        results = await asyncio.gather(*(manager.refresh(stale) for _ in range(5)), return_exceptions=True)
+        assert server.requests == 1
+        assert all(isinstance(result, TokenRefreshError) for result in results)
+
+        # Следующая попытка снова идет на OAuth-сервер
+        server.fail = False
+        assert (await manager.refresh(stale))["access_token"] == "access-2"
+        assert server.requests == 2
+        await client.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_cancel_shared_refresh(tmp_path):
+    async def scenario():
+        server = OAuthServer()
+        manager, client = await _manager(tmp_path, server)
+        stale = await manager.repo.load(domain=DOMAIN)
+
+        impatient = asyncio.create_task(manager.refresh(stale))
+        patient = asyncio.create_task(manager.refresh(stale))
+        await asyncio.sleep(0.01)
+        impatient.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await impatient
+        assert (await patient)["access_token"] == "access-1"
+        assert server.requests == 1
+        await client.aclose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import os
+import time
+import pytest
+from repositories.file_lock import FileLockTimeout
+from repositories.sqlite_token_store import SqliteTokenRepository
+from repositories.token_store import CachedJsonTokenRepository, JsonTokenRepository
+
+
+def test_save_during_reload_is_not_lost(tmp_path, monkeypatch):
+    """save(), пришедший пока кэш перечитывает файл, не затирается прочитанными данными."""
+    path = str(tmp_path / "tokens.json")
+
+    async def scenario():
+        repo = CachedJsonTokenRepository(path, check_interval=0, save_delay=0.01)
+        await repo.save({"domain": "a.bitrix24.ru", "access_token": "old"})
+        assert (await repo.load())["access_token"] == "old"
+
+        # Файл меняет другой процесс — следующий load() начнет перечитывание
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"domain": "a.bitrix24.ru", "access_token": "other"}, f)
+
+        reading, release = asyncio.Event(), asyncio.Event()
+        original_read = JsonTokenRepository._read
+
+        async def slow_read(self):
+            data = await original_read(self)
+            reading.set()
+            await release.wait()
+            return data
+
+        monkeypatch.setattr(JsonTokenRepository, "_read", slow_read)
+        load_task = asyncio.create_task(repo.load())
+        await reading.wait()
+        save_task = asyncio.create_task(repo.save({"domain": "a.bitrix24.ru", "access_token": "new"}))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(load_task, save_task)
+        monkeypatch.setattr(JsonTokenRepository, "_read", original_read)
+
+        assert (await repo.load())["access_token"] == "new"
+        with open(path, encoding="utf-8") as f:
+            assert json.load(f)["access_token"] == "new"
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_load_without_portal_finds_nothing(tmp_path):
+    """Хранилище множества порталов не отдает токены "последнего" портала вызову без domain / member_id."""
+    async def scenario():
+        repo = SqliteTokenRepository(str(tmp_path / "tokens.db"))
+        await repo.save({"domain": "a.bitrix24.ru", "member_id": "m-a", "access_token": "a"})
+        await repo.save({"domain": "b.bitrix24.ru", "member_id": "m-b", "access_token": "b"})
+        assert await repo.load() is None
+        assert (await repo.load(member_id="m-a"))["access_token"] == "a"
+        assert (await repo.load(domain="b.bitrix24.ru"))["access_token"] == "b"
+        await repo.close()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_lock_is_per_portal(tmp_path):
+    """Пока обновляется токен одного портала, блокировка другого портала свободна."""
+    async def scenario():
+        repo = SqliteTokenRepository(str(tmp_path / "tokens.db"))
+        async with repo.lock("a.bitrix24.ru"):
+            async with repo.lock("b.bitrix24.ru"):
+                pass
+            busy = repo.lock("a.bitrix24.ru")
+            busy.timeout = 0.05
+            with pytest.raises(FileLockTimeout):
+                async with busy:
+                    pass
+        await repo.close()
+
+    asyncio.run(scenario())
+
+
+def test_overlapping_flushes_keep_the_latest_save(tmp_path, monkeypatch):
+    """Сохранение во время медленной записи на диск не конфликтует с ней и не теряется."""
+    path = str(tmp_path / "tokens.json")
+
+    async def scenario():
+        repo = CachedJsonTokenRepository(path, check_interval=0, save_delay=0.01)
+        original_fsync = os.fsync
+
+        def slow_fsync(fd):
+            # Временный файл записан, но еще не переименован
+            time.sleep(0.05)
+            original_fsync(fd)
+
+        monkeypatch.setattr(os, "fsync", slow_fsync)
+        first = asyncio.create_task(repo.save({"domain": "a.bitrix24.ru", "access_token": "first"}))
+        await asyncio.sleep(0.03)
+        await repo.save({"domain": "a.bitrix24.ru", "access_token": "second"})
+        await first
+
+        with open(path, encoding="utf-8") as f:
+            assert json.load(f)["access_token"] == "second"
+        assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+    asyncio.run(scenario())